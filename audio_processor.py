@@ -0,0 +1,522 @@
+"""
+長音頻處理
+語音轉錄、記錄整理與對話回應，供 LINE Bot 與離線批次轉錄共用
+"""
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from linebot.models import TextSendMessage
+
+from model_router import ModelRouter
+from resilience import CircuitOpenError, ResilientOpenAI
+
+
+class LongAudioProcessor:
+    def __init__(self, openai_client=None, model_router=None, get_line_bot_api=None):
+        self.user_sessions = {}
+        self.processing_status = {}  # 追蹤處理狀態
+        # 帶逾時、重試與斷路器的 OpenAI 呼叫
+        self.openai_client = openai_client or ResilientOpenAI.from_env()
+        # 依任務與輸入長度選擇模型
+        self.model_router = model_router or ModelRouter.from_env()
+        # 回傳 LINE Messaging API 客戶端的函數（長音頻非同步處理時推播進度）
+        self.get_line_bot_api = get_line_bot_api
+    
+    def routed_completion(self, task, text, messages, endpoint='chat'):
+        """依路由表選擇模型參數後呼叫 ChatCompletion，並記錄延遲與 token 用量"""
+        selection = self.model_router.select(task, text)
+        start = time.time()
+        try:
+            response = self.openai_client.chat_completion(
+                endpoint=endpoint,
+                model=selection['model'],
+                messages=messages,
+                max_tokens=selection['max_tokens'],
+                temperature=selection['temperature']
+            )
+        except Exception:
+            self.model_router.record_error(selection, time.time() - start)
+            raise
+        
+        self.model_router.record(selection, time.time() - start, response.get('usage'))
+        return response
+    
+    def get_ai_response(self, user_id, message):
+        """獲取AI回應"""
+        try:
+            # 簡化的對話歷史管理
+            if user_id not in self.user_sessions:
+                self.user_sessions[user_id] = []
+            
+            # 添加系統提示
+            messages = [
+                {"role": "system", "content": """你是一個專業的工作助理AI。你的名字是「小助手」。
+                你擅長：
+                1. 協助規劃工作排程
+                2. 提供工作效率建議  
+                3. 幫助撰寫工作相關文件
+                4. 分析工作問題並提供解決方案
+                5. 處理會議記錄和語音轉文字（支援長達1.5小時的音頻）
+                
+                請用繁體中文回應，語氣專業但親切。回應要簡潔，適合手機閱讀。
+                每次回應不超過300字。"""}
+            ]
+            
+            # 保留最近3輪對話
+            recent_history = self.user_sessions[user_id][-6:]  # 3輪對話 = 6條訊息
+            messages.extend(recent_history)
+            messages.append({"role": "user", "content": message})
+            
+            # 調用OpenAI API
+            response = self.routed_completion('chat', message, messages)
+            
+            ai_reply = response.choices[0].message.content
+            
+            # 更新對話歷史
+            self.user_sessions[user_id].append({"role": "user", "content": message})
+            self.user_sessions[user_id].append({"role": "assistant", "content": ai_reply})
+            
+            return ai_reply
+            
+        except Exception as e:
+            return f"抱歉，處理您的請求時發生錯誤。請稍後再試。\n錯誤詳情：{str(e)}"
+    
+    def split_audio_file(self, audio_content, filename, chunk_duration=600):
+        """
+        改進的音頻檔案分割方法
+        對於大檔案，如果無法智能分割，直接使用原檔案
+        """
+        try:
+            file_size_mb = len(audio_content) / 1024 / 1024
+            
+            # 如果檔案小於25MB，直接處理不分割
+            if file_size_mb < 25:
+                print(f"檔案大小 {file_size_mb:.1f}MB，直接處理")
+                return [audio_content]
+            
+            # 對於大檔案，嘗試簡單分割
+            # 但確保分割點在合理位置
+            print(f"檔案大小 {file_size_mb:.1f}MB，嘗試分割")
+            
+            # 創建臨時檔案
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.m4a') as temp_file:
+                temp_file.write(audio_content)
+                input_path = temp_file.name
+            
+            # 檢查檔案是否有效
+            try:
+                # 先測試原檔案是否可以被OpenAI處理
+                with open(input_path, 'rb') as test_file:
+                    # 如果檔案不太大，直接嘗試處理
+                    if file_size_mb < 40:
+                        print("檔案大小適中，嘗試直接處理")
+                        os.unlink(input_path)
+                        return [audio_content]
+                
+                # 對於非常大的檔案，使用固定大小分割
+                # 但要確保不破壞音頻結構
+                max_chunk_size = 20 * 1024 * 1024  # 20MB
+                
+                # 分割策略：找到相對安全的分割點
+                chunks = []
+                current_pos = 0
+                
+                while current_pos < len(audio_content):
+                    # 計算這個chunk的結束位置
+                    end_pos = min(current_pos + max_chunk_size, len(audio_content))
+                    
+                    # 如果不是最後一個chunk，嘗試在靜音處分割
+                    if end_pos < len(audio_content):
+                        # 在chunk邊界附近尋找可能的分割點
+                        # 這裡簡化處理，使用固定分割
+                        chunk = audio_content[current_pos:end_pos]
+                    else:
+                        # 最後一個chunk
+                        chunk = audio_content[current_pos:]
+                    
+                    if len(chunk) > 0:
+                        chunks.append(chunk)
+                    
+                    current_pos = end_pos
+                
+                os.unlink(input_path)
+                print(f"分割完成，共 {len(chunks)} 個片段")
+                return chunks
+                
+            except Exception as e:
+                print(f"檔案檢查失敗: {e}")
+                os.unlink(input_path)
+                # 如果檔案檢查失敗，嘗試直接處理
+                if file_size_mb < 30:
+                    return [audio_content]
+                else:
+                    # 檔案太大且無法分割，返回錯誤
+                    return []
+                
+        except Exception as e:
+            print(f"音頻分割失敗: {e}")
+            # 回退到直接處理
+            return [audio_content] if len(audio_content) < 25 * 1024 * 1024 else []
+    
+    def transcribe_chunk(self, chunk, suffix='.m4a'):
+        """轉錄單一音頻片段，失敗時拋出例外"""
+        # 創建臨時檔案
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+            temp_file.write(chunk)
+            temp_file_path = temp_file.name
+        
+        try:
+            return self.transcribe_file(temp_file_path)
+        finally:
+            # 清理臨時檔案
+            os.unlink(temp_file_path)
+    
+    def transcribe_file(self, path):
+        """轉錄磁碟上的音頻檔案，失敗時拋出例外"""
+        # 調用Whisper API
+        with open(path, 'rb') as audio_file:
+            transcript = self.openai_client.transcribe(
+                model="whisper-1",
+                file=audio_file,
+                language="zh"
+            )
+        return transcript.text
+    
+    def transcribe_audio_chunks(self, chunks, filename, errors=None):
+        """處理音頻片段列表；傳入 errors 串列時會收集各片段的例外"""
+        try:
+            all_transcripts = []
+            total_chunks = len(chunks)
+            failed_chunks = 0
+            last_error = None
+            
+            print(f"開始處理 {total_chunks} 個音頻片段")
+            
+            for i, chunk in enumerate(chunks):
+                print(f"處理片段 {i+1}/{total_chunks}")
+                
+                try:
+                    transcript_text = self.transcribe_chunk(chunk)
+                    all_transcripts.append(f"[片段 {i+1}] {transcript_text}")
+                    print(f"片段 {i+1} 轉錄成功: {len(transcript_text)} 字符")
+                    
+                except Exception as e:
+                    print(f"片段 {i+1} 轉錄失敗: {e}")
+                    all_transcripts.append(f"[片段 {i+1}] 轉錄失敗: {str(e)}")
+                    failed_chunks += 1
+                    last_error = e
+                    if errors is not None:
+                        errors.append(e)
+                
+                # 避免API限制，片段間休息
+                if i < total_chunks - 1:
+                    time.sleep(1)
+            
+            # 所有片段都失敗時視為處理失敗，不產生只有錯誤訊息的摘要
+            if failed_chunks == total_chunks:
+                return None, f"所有片段轉錄失敗：{str(last_error)}"
+            
+            # 合併所有轉錄結果
+            full_transcript = "\n\n".join(all_transcripts)
+            
+            # 使用AI分析完整內容
+            summary = self.analyze_long_transcription(full_transcript, total_chunks)
+            
+            return full_transcript, summary
+            
+        except Exception as e:
+            return None, f"長音頻處理失敗：{str(e)}"
+    
+    def transcribe_single_audio(self, audio_content, filename):
+        """處理單一音頻檔案（不分割）"""
+        try:
+            print(f"開始處理單一音頻檔案: {filename}, 大小: {len(audio_content)} bytes")
+            
+            # 調用Whisper API（臨時檔案由 transcribe_chunk 清理）
+            transcribed_text = self.transcribe_chunk(audio_content)
+            print(f"轉錄成功: {len(transcribed_text)} 字符")
+            
+            # 使用AI分析和摘要
+            summary = self.analyze_transcription(transcribed_text)
+            
+            return transcribed_text, summary
+            
+        except Exception as e:
+            print(f"單一音頻處理失敗: {e}")
+            return None, f"語音轉文字處理失敗：{str(e)}"
+    
+    def analyze_transcription(self, text, raise_errors=False):
+        """
+        分析轉錄文字並生成智能記錄整理
+        預設失敗時回傳錯誤說明文字；raise_errors=True 時拋出例外（批次轉錄用以判斷是否需要重試）
+        """
+        try:
+            analysis_prompt = f"""請將以下語音記錄整理成專業的會議或記錄摘要，直接提供結構化的整理結果：
+
+語音內容：
+{text}
+
+請提供完整的記錄整理，包括：
+
+🎯 **重點摘要**
+[用2-3句話概括主要內容]
+
+📋 **主要議題**
+[條列式列出討論的重點議題]
+
+✅ **重要決議**
+[如果有決定或結論，明確列出]
+
+📝 **行動項目**
+[需要執行的具體任務，包含負責人和時間]
+
+📊 **關鍵數據**
+[提及的重要數字、日期、金額等]
+
+👥 **相關人員**
+[參與或提及的重要人物]
+
+⏰ **時間安排**
+[重要的截止日期或時程安排]
+
+💡 **補充說明**
+[其他重要細節或注意事項]
+
+請用繁體中文，條理清晰，直接可用作正式記錄。避免提及"語音記錄"等字眼，直接以會議記錄的格式呈現。"""
+
+            response = self.routed_completion(
+                'summary', text, [{"role": "user", "content": analysis_prompt}], endpoint='summary'
+            )
+            
+            return response.choices[0].message.content
+            
+        except Exception as e:
+            if raise_errors:
+                raise
+            return f"記錄整理失敗：{str(e)}"
+    
+    def analyze_long_transcription(self, text, chunk_count, raise_errors=False):
+        """分析長轉錄文字並生成摘要（raise_errors 同 analyze_transcription）"""
+        try:
+            analysis_prompt = f"""請分析以下長會議記錄（共{chunk_count}個片段），並提供結構化摘要：
+
+原始內容：
+{text[:4000]}{"..." if len(text) > 4000 else ""}
+
+請提供：
+1. 🎯 會議重點摘要（3-5句話）
+2. 📋 主要討論議題（條列式）
+3. ✅ 重要決議事項（如果有）
+4. 📝 行動項目和負責人（如果有）
+5. ⏰ 重要時間點或截止日期（如果有）
+6. 👥 參與人員或提及對象（如果有）
+7. 📊 數據或關鍵數字（如果有）
+
+請用繁體中文回應，格式清晰易讀。由於是長會議記錄，請特別注意整體結構和重點歸納。"""
+
+            response = self.routed_completion(
+                'long_summary', text, [{"role": "user", "content": analysis_prompt}], endpoint='summary'
+            )
+            
+            return response.choices[0].message.content
+            
+        except Exception as e:
+            if raise_errors:
+                raise
+            return f"摘要分析失敗：{str(e)}"
+    
+    def process_long_audio_async(self, user_id, audio_content, filename, file_id, defer_on_outage=False):
+        """
+        異步處理長音頻
+        defer_on_outage 用於佇列中的工作：轉錄失敗且語音服務尚未完全恢復（斷路器開啟或半開、
+        或片段因斷路器被拒絕）時不通知失敗，回傳 False 讓佇列重新排入
+        """
+        try:
+            # 更新處理狀態
+            self.processing_status[user_id] = {
+                'status': 'processing',
+                'filename': filename,
+                'start_time': datetime.now()
+            }
+            
+            # 發送進度更新（佇列中的工作已通知過用戶，重試時不重複推播）
+            if not defer_on_outage:
+                self.get_line_bot_api().push_message(
+                    user_id,
+                    TextSendMessage(text=f"🔄 開始分析長音頻檔案...\n📎 檔案：{filename}\n📏 大小：{len(audio_content)/1024/1024:.1f}MB")
+                )
+            
+            # 分割音頻
+            chunks = self.split_audio_file(audio_content, filename)
+            chunk_count = len(chunks)
+            
+            if not defer_on_outage:
+                self.get_line_bot_api().push_message(
+                    user_id,
+                    TextSendMessage(text=f"✂️ 音頻分割完成！\n📂 共分割為 {chunk_count} 個片段\n🎙️ 開始逐段轉錄...")
+                )
+            
+            # 處理各個片段
+            chunk_errors = []
+            full_transcript, summary = self.transcribe_audio_chunks(chunks, filename, chunk_errors)
+            
+            if full_transcript:
+                # 成功處理
+                self.processing_status[user_id]['status'] = 'completed'
+                
+                # 準備結果訊息（分段發送）
+                processing_time = (datetime.now() - self.processing_status[user_id]['start_time']).total_seconds()
+                
+                # 第一則：處理完成資訊
+                info_message = f"""🎉 長音頻轉文字完成！
+
+📎 檔案：{filename}
+📊 統計：{chunk_count} 個片段，約 {len(full_transcript)} 字符
+⏱️ 處理時間：{processing_time:.0f}秒"""
+                
+                # 第二則：轉錄內容（分段）
+                transcript_messages = []
+                transcript_header = "📝 完整轉錄內容：\n"
+                
+                if len(full_transcript) <= 4500:
+                    transcript_messages.append(transcript_header + full_transcript)
+                else:
+                    transcript_messages.append(transcript_header + "[內容較長，分段顯示]")
+                    
+                    # 分段顯示
+                    chunk_size = 4500
+                    for i in range(0, len(full_transcript), chunk_size):
+                        chunk = full_transcript[i:i + chunk_size]
+                        part_num = i // chunk_size + 1
+                        total_parts = (len(full_transcript) + chunk_size - 1) // chunk_size
+                        
+                        chunk_message = f"📝 轉錄內容 ({part_num}/{total_parts})：\n{chunk}"
+                        transcript_messages.append(chunk_message)
+                
+                # 第三則：AI摘要
+                summary_message = f"🤖 AI智能分析：\n{summary}"
+                if len(summary_message) > 4800:
+                    summary_message = f"🤖 AI智能分析：\n{summary[:4500]}...\n[摘要已截斷]"
+                
+                # 組合所有要發送的訊息
+                all_messages = [info_message] + transcript_messages + [summary_message]
+                all_messages.append("💡 長音頻轉錄完成！您可以繼續詢問相關問題！")
+                
+                # 逐一發送
+                for i, message in enumerate(all_messages):
+                    try:
+                        self.get_line_bot_api().push_message(user_id, TextSendMessage(text=message))
+                        if i < len(all_messages) - 1:
+                            time.sleep(0.5)
+                    except Exception as e:
+                        print(f"發送長音頻結果訊息 {i+1} 失敗: {e}")
+                        continue
+                
+            elif defer_on_outage and (
+                any(isinstance(e, CircuitOpenError) for e in chunk_errors)
+                or not self.openai_client.is_closed('audio')
+            ):
+                # 上游仍未恢復，交由佇列等待下一次放行
+                self.processing_status[user_id]['status'] = 'queued'
+                print(f"語音服務仍無法連線，{filename} 重新排入佇列: {summary}")
+                return False
+                
+            else:
+                # 處理失敗
+                self.processing_status[user_id]['status'] = 'failed'
+                result_text = f"""❌ 長音頻處理失敗
+
+📎 檔案：{filename}
+{summary}
+
+建議：
+• 檢查音頻檔案品質
+• 嘗試較短的音頻片段
+• 確認檔案格式正確"""
+                
+                self.get_line_bot_api().push_message(
+                    user_id,
+                    TextSendMessage(text=result_text)
+                )
+            
+        except Exception as e:
+            # 處理異常
+            self.processing_status[user_id]['status'] = 'error'
+            error_msg = f"""❌ 長音頻處理出現錯誤
+
+📎 檔案：{filename}
+錯誤：{str(e)}
+
+請稍後重試或嘗試較小的檔案。"""
+            
+            self.get_line_bot_api().push_message(
+                user_id,
+                TextSendMessage(text=error_msg)
+            )
+    
+    def handle_quick_commands(self, message):
+        """處理快捷指令"""
+        message_lower = message.lower().strip()
+        
+        # 幫助指令
+        if message_lower in ['幫助', 'help', '功能', '指令', '使用說明']:
+            return """🤖 小助手工作助理
+
+📋 主要功能：
+• 工作規劃與排程建議
+• 效率提升技巧分享  
+• 文件撰寫協助
+• 問題分析與解決方案
+• 🎙️ 智能會議記錄整理（支援1.5小時+）
+• 🖼️ 白板 / 紙本議程照片文字辨識
+
+💬 使用方式：
+• 直接對話：「幫我規劃明天的工作」
+• 尋求建議：「如何提高工作效率？」
+• 文件協助：「幫我寫會議紀錄」
+• 🎙️ 會議記錄：上傳音頻檔案自動整理成專業記錄
+• 🖼️ 照片記錄：連續傳送多張照片，合併整理成一份記錄
+
+🎯 快捷指令：
+• 「今日規劃」- 獲得當日工作建議
+• 「效率技巧」- 查看提升效率的方法
+• 「時間管理」- 學習時間管理技巧
+
+🎙️ 智能記錄功能：
+• 支援最長1.5小時的會議錄音
+• 自動整理成專業會議記錄格式
+• 提取重點、決議、行動項目
+• 無需查看原始文字，直接獲得整理結果
+
+就像跟同事聊天一樣，告訴我你的工作需求吧！"""
+
+        # 其他快捷指令保持不變...
+        elif message_lower in ['今日規劃', '今天規劃', '今日安排']:
+            today = datetime.now().strftime("%Y年%m月%d日")
+            return f"""📅 {today} 工作規劃建議
+
+🌅 早晨安排（9:00-12:00）
+• 處理重要且緊急的任務
+• 回覆重要郵件和訊息
+• 完成需要高專注力的工作
+
+🌞 下午安排（13:00-17:00）
+• 開會和團隊協作
+• 處理例行性工作
+• 規劃明天的任務
+
+🌙 收尾時段（17:00-18:00）
+• 整理今日完成事項
+• 更新工作進度
+• 準備明天的重點工作
+
+💡 小提醒：記得每90分鐘休息一下，保持最佳工作狀態！
+
+🎙️ 長音頻提示：
+可以上傳長達1.5小時的會議錄音，我會自動分割處理並整理完整摘要！
+
+有特定的工作項目需要安排嗎？告訴我詳情，我可以給你更具體的建議！"""
+
+        return None
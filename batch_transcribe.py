@@ -0,0 +1,387 @@
+"""
+離線批次轉錄工具
+對資料夾或清單中的錄音檔執行與 LINE Bot 相同的分割 / 轉錄 / 摘要流程
+
+使用方式：
+    python batch_transcribe.py recordings/ --output-dir output
+    python batch_transcribe.py --manifest meetings.txt --workers 4 --api-concurrency 3
+    python batch_transcribe.py recordings/ --api-base http://127.0.0.1:8090/v1   # 搭配 stub_servers.py
+
+本機解碼與分割（ffmpeg 轉為單聲道 16kHz 低位元率片段）在行程池中平行執行，
+片段寫入暫存資料夾，主行程只取得檔案路徑；API 呼叫則以固定併發數限制。
+沒有安裝 ffmpeg 時改用與 LINE Bot 相同的位元組分割。
+結果逐檔寫入 results.jsonl 與 Markdown，中斷後重新執行會跳過已完成的檔案。
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from audio_processor import LongAudioProcessor
+from resilience import load_openai
+
+AUDIO_EXTENSIONS = ('.m4a', '.mp3', '.wav', '.aac', '.mp4', '.mpeg', '.mpga', '.ogg', '.webm', '.flac')
+
+# 每個片段 10 分鐘，32kbps 單聲道約 2.4MB，遠低於 Whisper 的 25MB 上限
+SEGMENT_SECONDS = 600
+
+# 行程池內各自持有的處理器實例
+_processor = None
+
+
+def get_processor():
+    """取得目前行程的 LongAudioProcessor"""
+    global _processor
+    if _processor is None:
+        _processor = LongAudioProcessor()
+    return _processor
+
+
+def collect_inputs(paths, manifest=None):
+    """整理要處理的音頻檔案清單（資料夾、檔案或清單檔）"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(AUDIO_EXTENSIONS):
+                        files.append(os.path.join(root, name))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(f"⚠️ 找不到路徑，略過: {path}")
+
+    if manifest:
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                # 支援純路徑或 JSONL（{"path": ...}）
+                if line.startswith('{'):
+                    line = json.loads(line)['path']
+                if not os.path.isabs(line):
+                    line = os.path.join(base_dir, line)
+                files.append(line)
+
+    # 去除重複並保持順序
+    seen = set()
+    result = []
+    for path in files:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            result.append(path)
+    return result
+
+
+def probe_duration(path):
+    """取得音頻長度（秒），無法判斷時回傳 None"""
+    try:
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+             '-of', 'default=noprint_wrappers=1:nokey=1', path],
+            capture_output=True, text=True, timeout=60
+        )
+        if output.returncode == 0 and output.stdout.strip():
+            return float(output.stdout.strip())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        pass
+
+    # 沒有 ffprobe 時，WAV 檔可直接讀取標頭
+    if path.lower().endswith('.wav'):
+        try:
+            with wave.open(path, 'rb') as wav_file:
+                return wav_file.getnframes() / float(wav_file.getframerate())
+        except (wave.Error, OSError, EOFError):
+            pass
+    return None
+
+
+def segment_audio(path, work_dir, segment_seconds=SEGMENT_SECONDS):
+    """以 ffmpeg 解碼並重新編碼成固定長度的片段，回傳片段路徑"""
+    pattern = os.path.join(work_dir, 'segment_%03d.mp3')
+    subprocess.run(
+        ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', path, '-vn',
+         '-ac', '1', '-ar', '16000', '-c:a', 'libmp3lame', '-b:a', '32k',
+         '-f', 'segment', '-segment_time', str(segment_seconds), '-reset_timestamps', '1', pattern],
+        capture_output=True, check=True
+    )
+    return sorted(os.path.join(work_dir, name) for name in os.listdir(work_dir))
+
+
+def split_to_files(path, work_dir):
+    """沒有 ffmpeg 時以位元組分割，片段寫入暫存資料夾後回傳路徑"""
+    with open(path, 'rb') as f:
+        audio_content = f.read()
+    suffix = os.path.splitext(path)[1] or '.m4a'
+
+    segments = []
+    for i, chunk in enumerate(get_processor().split_audio_file(audio_content, os.path.basename(path))):
+        segment_path = os.path.join(work_dir, f"segment_{i:03d}{suffix}")
+        with open(segment_path, 'wb') as f:
+            f.write(chunk)
+        segments.append(segment_path)
+    return segments
+
+
+def prepare_audio(path, use_ffmpeg):
+    """在行程池中解析長度並分割音頻檔案，片段寫入暫存資料夾（只回傳路徑，避免大量資料跨行程傳遞）"""
+    start = time.time()
+    work_dir = tempfile.mkdtemp(prefix='batch_transcribe_')
+    try:
+        duration = probe_duration(path)
+        segments = segment_audio(path, work_dir) if use_ffmpeg else split_to_files(path, work_dir)
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    return {
+        'path': path,
+        'filename': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'duration': duration,
+        'segments': segments,
+        'work_dir': work_dir,
+        'prepare_time': time.time() - start
+    }
+
+
+class ResultWriter:
+    """將結果寫入 JSONL 與 Markdown，並記錄已完成的檔案以便續跑"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.jsonl_path = os.path.join(output_dir, 'results.jsonl')
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def completed_paths(self):
+        """讀取先前已成功處理的檔案"""
+        done = set()
+        if not os.path.exists(self.jsonl_path):
+            return done
+        with open(self.jsonl_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 上次中斷時可能留下不完整的最後一行
+                    continue
+                if record.get('status') == 'completed':
+                    done.add(record['path'])
+        return done
+
+    def markdown_path(self, path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.output_dir, f"{stem}-{digest}.md")
+
+    def write(self, record):
+        with self._lock:
+            if record['status'] == 'completed':
+                record['markdown'] = self.markdown_path(record['path'])
+                with open(record['markdown'], 'w', encoding='utf-8') as f:
+                    f.write(self.render_markdown(record))
+            with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def render_markdown(self, record):
+        duration = record.get('duration')
+        duration_text = f"{duration / 60:.1f} 分鐘" if duration else "未知"
+        return f"""# {record['filename']}
+
+- 來源檔案：`{record['path']}`
+- 音頻長度：{duration_text}
+- 片段數量：{record['chunks']}
+- 處理時間：{record['elapsed']:.1f} 秒
+- 完成時間：{record['finished_at']}
+
+## 🤖 AI智能分析
+
+{record['summary']}
+
+## 📝 完整轉錄內容
+
+{record['transcript']}
+"""
+
+
+def transcribe_prepared(prepared, api_pool):
+    """將分割後的片段送往 API 轉錄並產生摘要（API 呼叫受 api_pool 併發數限制）"""
+    processor = get_processor()
+    segments = prepared['segments']
+    start = time.time()
+    record = {
+        'path': prepared['path'],
+        'filename': prepared['filename'],
+        'size': prepared['size'],
+        'duration': prepared['duration'],
+        'chunks': len(segments),
+    }
+
+    try:
+        transcribe_segments(processor, segments, record, api_pool)
+    finally:
+        shutil.rmtree(prepared['work_dir'], ignore_errors=True)
+
+    record['elapsed'] = prepared['prepare_time'] + (time.time() - start)
+    record['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    return record
+
+
+def transcribe_segments(processor, segments, record, api_pool):
+    """轉錄所有片段並產生摘要，結果寫入 record"""
+    if not segments:
+        record.update(status='failed', error="檔案太大且無法分割")
+    else:
+        futures = [api_pool.submit(processor.transcribe_file, segment) for segment in segments]
+
+        transcripts = []
+        errors = []
+        for i, future in enumerate(futures):
+            try:
+                transcripts.append(future.result())
+            except Exception as e:
+                errors.append(f"片段 {i+1}: {e}")
+                transcripts.append(f"轉錄失敗: {str(e)}")
+
+        if errors:
+            record.update(status='failed', error="; ".join(errors))
+        else:
+            # 與 LINE 流程相同：單一片段用完整記錄整理，多片段用長會議摘要
+            # 摘要失敗時記為 failed，下次執行會重新處理，而不是把錯誤訊息當成摘要
+            try:
+                if len(segments) == 1:
+                    full_transcript = transcripts[0]
+                    summary = api_pool.submit(
+                        processor.analyze_transcription, full_transcript, raise_errors=True
+                    ).result()
+                else:
+                    full_transcript = "\n\n".join(f"[片段 {i+1}] {text}" for i, text in enumerate(transcripts))
+                    summary = api_pool.submit(
+                        processor.analyze_long_transcription, full_transcript, len(segments), raise_errors=True
+                    ).result()
+            except Exception as e:
+                record.update(status='failed', error=f"摘要失敗: {e}")
+            else:
+                record.update(status='completed', transcript=full_transcript, summary=summary)
+
+
+def run_batch(files, writer, workers, api_concurrency, use_ffmpeg):
+    """執行批次處理，回傳所有結果紀錄"""
+    results = []
+    max_in_flight = max(workers, api_concurrency) * 2
+    pending_paths = list(reversed(files))
+
+    with ProcessPoolExecutor(max_workers=workers) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=api_concurrency) as api_pool, \
+            ThreadPoolExecutor(max_workers=max_in_flight) as file_pool:
+        in_flight = {}
+
+        def fill():
+            # 限制同時處理中的檔案數，避免暫存片段堆積
+            while pending_paths and len(in_flight) < max_in_flight:
+                path = pending_paths.pop()
+                in_flight[cpu_pool.submit(prepare_audio, path, use_ffmpeg)] = ('prepare', path)
+
+        fill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, path = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = None
+                    record = {
+                        'path': path,
+                        'filename': os.path.basename(path),
+                        'status': 'failed',
+                        'error': str(e),
+                        'finished_at': datetime.now().isoformat(timespec='seconds')
+                    }
+
+                if stage == 'prepare' and result is not None:
+                    print(f"✂️ 分割完成: {result['filename']}（{len(result['segments'])} 個片段）")
+                    in_flight[file_pool.submit(transcribe_prepared, result, api_pool)] = ('transcribe', path)
+                    continue
+                if result is not None:
+                    record = result
+
+                writer.write(record)
+                results.append(record)
+                icon = "✅" if record['status'] == 'completed' else "❌"
+                print(f"{icon} {record['filename']}: {record['status']}"
+                      + (f"（{record['error']}）" if record.get('error') else ""))
+            fill()
+
+    return results
+
+
+def report(results, wall_time):
+    """輸出處理統計與吞吐量（音頻小時 / 實際小時）"""
+    completed = [r for r in results if r['status'] == 'completed']
+    failed = len(results) - len(completed)
+    audio_seconds = sum(r.get('duration') or 0 for r in completed)
+    unknown = sum(1 for r in completed if not r.get('duration'))
+
+    print("\n📊 批次處理統計")
+    print(f"• 完成：{len(completed)} 個檔案，失敗：{failed} 個")
+    print(f"• 音頻總長：{audio_seconds / 3600:.2f} 小時")
+    print(f"• 實際耗時：{wall_time:.1f} 秒")
+    if wall_time > 0 and audio_seconds:
+        print(f"• 吞吐量：{audio_seconds / wall_time:.1f} 音頻小時 / 實際小時")
+    if unknown:
+        print(f"• 有 {unknown} 個檔案無法判斷長度（未計入吞吐量，請安裝 ffprobe）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="離線批次轉錄會議錄音")
+    parser.add_argument('inputs', nargs='*', help="音頻檔案或資料夾")
+    parser.add_argument('--manifest', help="清單檔（每行一個路徑，或 JSONL 含 path 欄位）")
+    parser.add_argument('--output-dir', default='batch_output', help="輸出資料夾（預設 batch_output）")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="本機解碼/分割的行程數")
+    parser.add_argument('--api-concurrency', type=int, default=3, help="同時進行的 API 呼叫數")
+    parser.add_argument('--api-base', help="OpenAI API 位址（例如本機模擬伺服器）")
+    args = parser.parse_args(argv)
+
+    if args.api_base:
+        openai = load_openai()
+        openai.api_base = args.api_base
+        # 模擬伺服器不檢查金鑰，但 SDK 要求必須設定
+        openai.api_key = openai.api_key or 'stub'
+
+    files = collect_inputs(args.inputs, args.manifest)
+    writer = ResultWriter(args.output_dir)
+    done = writer.completed_paths()
+    todo = [path for path in files if path not in done]
+
+    print(f"🎙️ 共 {len(files)} 個檔案，已完成 {len(files) - len(todo)} 個，待處理 {len(todo)} 個")
+    if not todo:
+        return 0
+
+    use_ffmpeg = shutil.which('ffmpeg') is not None
+    if not use_ffmpeg:
+        print("⚠️ 找不到 ffmpeg，改用位元組分割（大檔案的片段可能無法被正確解碼）")
+
+    start = time.time()
+    results = run_batch(todo, writer, max(1, args.workers), max(1, args.api_concurrency), use_ffmpeg)
+    report(results, time.time() - start)
+    return 0 if all(r['status'] == 'completed' for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+端對端重播基準測試
+啟動本機模擬的 LINE 與 OpenAI 伺服器，對 app 重播簽章正確的合成 webhook 流量
+（文字、短語音、長檔案、圖片混合），量測吞吐量、各事件類型延遲、尖峰記憶體與 API 呼叫次數
+
+使用方式：
+    python bench_replay.py                                  # 與 bench_baseline.json 比較
+    python bench_replay.py --save-baseline                  # 更新基準
+    python bench_replay.py --openai-latency 1 --openai-error-rate 0.1 --fail-on-regression
+
+延遲分為兩種：
+• callback：/callback 的 HTTP 回應時間（LINE 平台等待的時間）
+• complete：從送出 webhook 到該用戶最後一則 reply / push 的時間（用戶實際等待的時間）
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_startup import bench_env, free_port, sign, start_server, stop_server
+from stub_servers import start_stub_line, start_stub_openai
+
+DEFAULT_MIX = 'text=0.7,voice=0.2,file=0.1'
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+TEXT_MESSAGES = [
+    '幫我規劃明天的工作',
+    '如何提高工作效率？',
+    '幫我寫一份週會的會議紀錄範本',
+    '下週要跟客戶簡報，該怎麼準備？',
+    'help',
+    '今日規劃',
+]
+
+
+def parse_mix(mix):
+    """解析事件比例，例如 text=0.7,voice=0.2,file=0.1"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('text', 'voice', 'file', 'image'):
+            raise ValueError(f"未知的事件類型: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+def make_image(size_px):
+    """產生一張有雜訊的測試圖片（模擬手機照片的壓縮難度）"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((size_px, size_px * 3 // 4), 40).convert('RGB').save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def build_events(args, line_stub):
+    """產生合成事件並在 LINE 模擬伺服器登記下載內容（相同類型共用同一份內容）"""
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    kinds = list(weights)
+    contents = {
+        'voice': b"\0" * int(args.voice_kb * 1024),
+        'file': b"\0" * int(args.file_mb * 1024 * 1024),
+    }
+    if 'image' in kinds:
+        contents['image'] = make_image(args.image_px)
+
+    events = []
+    burst_user, burst_left = None, 0
+    for i in range(args.events):
+        kind = rng.choices(kinds, weights=[weights[k] for k in kinds])[0]
+        user_id = f"Ubench{i:05d}"
+        if kind == 'text':
+            # 連續文字訊息由同一位用戶送出
+            if burst_left:
+                user_id = burst_user
+                burst_left -= 1
+            else:
+                burst_user, burst_left = user_id, args.text_burst - 1
+        message_id = f"{100000 + i}"
+        reply_token = f"reply-{i:05d}"
+
+        if kind == 'text':
+            message = {'id': message_id, 'type': 'text', 'text': rng.choice(TEXT_MESSAGES)}
+        elif kind == 'voice':
+            message = {'id': message_id, 'type': 'audio', 'duration': 60000,
+                       'contentProvider': {'type': 'line'}}
+        elif kind == 'file':
+            message = {'id': message_id, 'type': 'file', 'fileName': f'meeting_{i}.m4a',
+                       'fileSize': len(contents['file'])}
+        else:
+            message = {'id': message_id, 'type': 'image', 'contentProvider': {'type': 'line'}}
+
+        if kind in contents:
+            line_stub.contents[message_id] = contents[kind]
+
+        body = json.dumps({
+            'destination': 'Ubenchbot',
+            'events': [{
+                'type': 'message',
+                'mode': 'active',
+                'timestamp': int(time.time() * 1000),
+                'source': {'type': 'user', 'userId': user_id},
+                'webhookEventId': f"bench-{i}",
+                'deliveryContext': {'isRedelivery': False},
+                'replyToken': reply_token,
+                'message': message,
+            }]
+        }).encode('utf-8')
+        events.append({'kind': kind, 'user_id': user_id, 'reply_token': reply_token, 'body': body})
+    return events
+
+
+def start_app(server, env):
+    """以子行程啟動 app，等待健康檢查通過後回傳 (process, port)"""
+    port = free_port()
+    process = start_server(server, port, env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=2):
+                return process, port
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.05)
+    stop_server(process)
+    raise RuntimeError("app 在 30 秒內沒有啟動")
+
+
+def send_event(port, event):
+    """送出一個 webhook，記錄送出時間、回應狀態與延遲"""
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/callback",
+        data=event['body'],
+        headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(event['body'])},
+        method='POST'
+    )
+    event['sent_at'] = time.time()
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            event['status'] = response.status
+    except urllib.error.HTTPError as e:
+        event['status'] = e.code
+    except (urllib.error.URLError, ConnectionError) as e:
+        event['status'] = str(e)
+    event['callback_latency'] = time.time() - event['sent_at']
+
+
+def send_session(port, session, gap):
+    """依序送出同一位用戶的事件（模擬連續傳送）"""
+    for i, event in enumerate(session):
+        if i:
+            time.sleep(gap)
+        send_event(port, event)
+
+
+def wait_until_settled(stubs, settle, timeout):
+    """等待所有模擬伺服器連續 settle 秒沒有新請求（背景處理完成）"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        idle = time.time() - max(stub.last_activity for stub in stubs)
+        if idle >= settle:
+            return True
+        time.sleep(min(0.2, settle - idle))
+    return False
+
+
+def process_tree(pid):
+    """列出行程及其所有子行程（gunicorn 的 worker 是 master 的子行程）"""
+    pids = [pid]
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def peak_rss_mb(pid):
+    """讀取 app 行程樹的尖峰常駐記憶體總和（Linux /proc）"""
+    total = None
+    for tree_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total = (total or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return total
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def to_ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def summarize(events, line_stub, openai_stub, wall_time, rss):
+    """整理量測結果"""
+    # 每位用戶（每個事件一位）最後一次收到 reply / push 的時間
+    last_delivery = {}
+    token_owner = {event['reply_token']: event['user_id'] for event in events}
+    for delivery in line_stub.deliveries:
+        user_id = token_owner.get(delivery['target'], delivery['target'])
+        last_delivery[user_id] = max(last_delivery.get(user_id, 0), delivery['time'])
+
+    per_kind = {}
+    for kind in sorted({event['kind'] for event in events}):
+        group = [event for event in events if event['kind'] == kind]
+        callback = [event['callback_latency'] for event in group]
+        complete = [last_delivery[event['user_id']] - event['sent_at']
+                    for event in group if event['user_id'] in last_delivery]
+        per_kind[kind] = {
+            'count': len(group),
+            'errors': sum(1 for event in group if event['status'] != 200),
+            'undelivered': len(group) - len(complete),
+            'callback_p50_ms': to_ms(percentile(callback, 50)),
+            'callback_p95_ms': to_ms(percentile(callback, 95)),
+            'callback_p99_ms': to_ms(percentile(callback, 99)),
+            'complete_p50_ms': to_ms(percentile(complete, 50)),
+            'complete_p95_ms': to_ms(percentile(complete, 95)),
+            'complete_p99_ms': to_ms(percentile(complete, 99)),
+        }
+
+    return {
+        'events': len(events),
+        'wall_seconds': round(wall_time, 2),
+        'throughput_eps': round(len(events) / wall_time, 3) if wall_time else None,
+        'peak_rss_mb': round(rss, 1) if rss is not None else None,
+        'per_kind': per_kind,
+        'api_calls': {
+            'line': dict(sorted(line_stub.calls.items())),
+            'openai': dict(sorted(openai_stub.calls.items())),
+        },
+    }
+
+
+def print_results(results):
+    print(f"\n📊 重播結果：{results['events']} 個事件，耗時 {results['wall_seconds']} 秒")
+    print(f"• 吞吐量：{results['throughput_eps']} 事件/秒")
+    print(f"• 尖峰記憶體（app）：{results['peak_rss_mb']} MB")
+    print(f"\n{'類型':<8}{'數量':>6}{'錯誤':>6}"
+          f"{'cb p50':>10}{'cb p95':>10}{'cb p99':>10}{'done p50':>10}{'done p95':>10}{'done p99':>10}")
+    for kind, stats in results['per_kind'].items():
+        print(f"{kind:<8}{stats['count']:>8}{stats['errors'] + stats['undelivered']:>8}"
+              + "".join(f"{stats[key] if stats[key] is not None else '-':>10}" for key in (
+                  'callback_p50_ms', 'callback_p95_ms', 'callback_p99_ms',
+                  'complete_p50_ms', 'complete_p95_ms', 'complete_p99_ms')))
+    print("\n📡 API 呼叫次數")
+    for service, calls in results['api_calls'].items():
+        for path, count in calls.items():
+            print(f"• {service} {path}: {count}")
+
+
+def flatten_metrics(results):
+    """攤平成 (名稱, 數值, 越大越好) 以便與基準比較"""
+    metrics = [('throughput_eps', results['throughput_eps'], True),
+               ('peak_rss_mb', results['peak_rss_mb'], False)]
+    for kind, stats in results['per_kind'].items():
+        for key in ('callback_p50_ms', 'callback_p95_ms', 'callback_p99_ms',
+                    'complete_p50_ms', 'complete_p95_ms', 'complete_p99_ms'):
+            metrics.append((f"{kind}.{key}", stats[key], False))
+    for service, calls in results['api_calls'].items():
+        metrics.append((f"{service}.api_calls", sum(calls.values()), False))
+    return metrics
+
+
+def compare(results, baseline, threshold):
+    """與基準比較，回傳退步的指標清單"""
+    previous = {name: value for name, value, _ in flatten_metrics(baseline['results'])}
+    regressions = []
+    print(f"\n📈 與基準比較（門檻 ±{threshold:.0%}）")
+    for name, value, higher_is_better in flatten_metrics(results):
+        old = previous.get(name)
+        if value is None or not old:
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better else change
+        mark = "⚠️ 退步" if worse > threshold else ("✅ 改善" if worse < -threshold else "")
+        print(f"• {name}: {old} → {value}（{change:+.0%}）{mark}")
+        if worse > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端對端重播基準測試")
+    parser.add_argument('--events', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8, help="同時送出的 webhook 數")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"事件比例（預設 {DEFAULT_MIX}，可加入 image）")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--text-burst', type=int, default=1, help="同一用戶連續送出的文字訊息數")
+    parser.add_argument('--burst-gap', type=float, default=0.5, help="連續訊息之間的間隔（秒）")
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    parser.add_argument('--voice-kb', type=float, default=200, help="短語音大小（KB）")
+    parser.add_argument('--file-mb', type=float, default=55, help="長檔案大小（MB），超過 50MB 走非同步流程")
+    parser.add_argument('--image-px', type=int, default=3000, help="測試圖片寬度（像素）")
+    parser.add_argument('--openai-latency', type=float, default=0.3)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--line-latency', type=float, default=0.05)
+    parser.add_argument('--line-error-rate', type=float, default=0.0)
+    parser.add_argument('--settle', type=float, default=3, help="判定背景處理完成的閒置秒數")
+    parser.add_argument('--timeout', type=float, default=600, help="等待背景處理的最長秒數")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="將本次結果存為基準")
+    parser.add_argument('--threshold', type=float, default=0.2, help="視為退步的變化比例")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="額外傳給 app 的環境變數（可重複）")
+    args = parser.parse_args(argv)
+
+    openai_stub = start_stub_openai(latency=args.openai_latency, error_rate=args.openai_error_rate)
+    line_stub = start_stub_line(latency=args.line_latency, error_rate=args.line_error_rate, error_status=500)
+    events = build_events(args, line_stub)
+
+    env = bench_env({
+        'LINE_API_ENDPOINT': line_stub.base_url,
+        'LINE_API_DATA_ENDPOINT': line_stub.base_url,
+        'OPENAI_API_BASE': openai_stub.api_base,
+        'IMAGE_BACKEND': 'stub',
+    })
+    env.update(item.split('=', 1) for item in args.env)
+    scenario = {key: value for key, value in vars(args).items()
+                if key not in ('baseline', 'save_baseline', 'threshold', 'fail_on_regression', 'timeout')}
+
+    process, port = start_app(args.server, env)
+    print(f"🚀 app 已啟動（{args.server}，port {port}），開始重播 {len(events)} 個事件...")
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            sessions = {}
+            for event in events:
+                sessions.setdefault(event['user_id'], []).append(event)
+            list(pool.map(lambda session: send_session(port, session, args.burst_gap), sessions.values()))
+        if not wait_until_settled([line_stub, openai_stub], args.settle, args.timeout):
+            print(f"⚠️ {args.timeout} 秒內背景處理仍未結束")
+        # 扣除最後的閒置判定時間
+        wall_time = max(line_stub.last_activity, openai_stub.last_activity) - start
+        rss = peak_rss_mb(process.pid)
+    finally:
+        stop_server(process)
+
+    results = summarize(events, line_stub, openai_stub, wall_time, rss)
+    print_results(results)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('scenario') != scenario:
+            print("\n⚠️ 情境參數與基準不同，比較結果僅供參考")
+        regressions = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'scenario': scenario, 'results': results}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"\n💾 已儲存基準：{args.baseline}")
+
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+冷啟動基準測試
+量測 app 模組匯入時間，以及從啟動伺服器到第一個 /callback 成功回應的時間
+
+使用方式：
+    python bench_startup.py
+    python bench_startup.py --runs 10 --server werkzeug
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+CHANNEL_SECRET = 'bench-secret'
+
+BENCH_ENV = {
+    'LINE_CHANNEL_ACCESS_TOKEN': 'bench-token',
+    'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+    'OPENAI_API_KEY': 'bench-key',
+}
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.preload()
+app.init_clients()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+WERKZEUG_SNIPPET = """
+import sys
+from werkzeug.serving import run_simple
+import app
+app.preload()
+app.init_clients()
+run_simple('127.0.0.1', int(sys.argv[1]), app.app, threaded=True)
+"""
+
+
+def bench_env(extra=None):
+    env = dict(os.environ)
+    env.update(BENCH_ENV)
+    env.update(extra or {})
+    return env
+
+
+def sign(body):
+    """依 LINE 規格產生 X-Line-Signature"""
+    digest = hmac.new(CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(runs):
+    """在新的直譯器中量測匯入與客戶端初始化時間"""
+    import_times = []
+    init_times = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SNIPPET],
+            capture_output=True, text=True, env=bench_env(), check=True
+        )
+        import_time, init_time = map(float, output.stdout.strip().splitlines()[-1].split())
+        import_times.append(import_time)
+        init_times.append(init_time)
+    return import_times, init_times
+
+
+def start_server(server, port, env):
+    """以子行程啟動 app（gunicorn 或 werkzeug），回傳 Popen"""
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    else:
+        command = [sys.executable, '-c', WERKZEUG_SNIPPET, str(port)]
+    return subprocess.Popen(
+        command, env=dict(env, PORT=str(port)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+
+def stop_server(process, timeout=10):
+    """
+    結束伺服器行程；worker 仍在啟動時收到的 SIGTERM 可能被忽略，
+    逾時後強制結束，避免等待整個 graceful_timeout
+    """
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def measure_first_callback(server, timeout=30):
+    """啟動伺服器並重複送出簽章正確的空事件 webhook，直到回應 200"""
+    port = free_port()
+    body = json.dumps({'destination': 'bench', 'events': []}).encode('utf-8')
+    callback_request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/callback",
+        data=body,
+        headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body)},
+        method='POST'
+    )
+
+    start = time.perf_counter()
+    process = start_server(server, port, bench_env())
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(callback_request, timeout=5) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise RuntimeError(f"{server} 在 {timeout} 秒內沒有成功回應 /callback")
+    finally:
+        stop_server(process)
+
+
+def describe(label, samples):
+    median = statistics.median(samples) * 1000
+    print(f"• {label}：中位數 {median:.0f} ms（最小 {min(samples) * 1000:.0f} / 最大 {max(samples) * 1000:.0f}）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="冷啟動基準測試")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    args = parser.parse_args(argv)
+
+    import_times, init_times = measure_import(args.runs)
+    callback_times = [measure_first_callback(args.server) for _ in range(args.runs)]
+
+    print(f"🚀 冷啟動基準測試（{args.runs} 次）")
+    describe("匯入 app", import_times)
+    describe("初始化客戶端", init_times)
+    describe(f"啟動到第一個 /callback 成功（{args.server}）", callback_times)
+
+
+if __name__ == "__main__":
+    main()
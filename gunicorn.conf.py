@@ -0,0 +1,43 @@
+"""
+gunicorn 設定
+Webhook 處理大多在等待 LINE / OpenAI 回應（I/O 密集），因此使用 gthread worker：
+單一 worker 內以多執行緒同時處理多個請求，長時間的轉錄不會卡住其他用戶。
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# 主行程預先載入程式碼，fork 後共用記憶體頁面，worker 啟動不需重新匯入
+preload_app = True
+
+# 對話紀錄、訊息合併、圖片批次、音頻佇列與斷路器狀態都保存在行程記憶體中，預設只用單一 worker。
+# 不讀取 WEB_CONCURRENCY：Heroku 依 dyno 大小自動設定該值，會在不知情下變成多行程，
+# 同一用戶的請求分散到不同 worker 後對話與合併狀態會錯亂。
+# 確定要多行程時，明確設定 GUNICORN_WORKERS
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# gthread 的心跳由 worker 主迴圈送出，長請求在執行緒中不會觸發 timeout；
+# 這裡的 timeout 只用來回收真正卡死的 worker
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 120
+keepalive = 5
+
+# 不定期回收 worker：長音頻執行緒、音頻佇列、待合併的訊息與圖片批次、對話紀錄都只存在 worker 記憶體中，
+# 回收時 graceful shutdown 不會等待這些背景執行緒，工作會直接遺失。
+# 若需要以回收控制記憶體，設定 GUNICORN_MAX_REQUESTS 並接受上述資料遺失
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 5
+
+
+def when_ready(server):
+    """fork worker 前在主行程載入 openai 等純程式碼相依套件，worker 共用記憶體頁面且不需各自匯入"""
+    import app
+    app.preload()
+
+
+def post_fork(server, worker):
+    """fork 後在各 worker 建立 LINE 客戶端（連線不可跨行程共用）"""
+    import app
+    app.init_clients()
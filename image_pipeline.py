@@ -0,0 +1,252 @@
+"""
+圖片處理流程
+串流下載用戶傳送的圖片，在執行緒池中縮小並重新壓縮，
+短時間內傳送的多張圖片合併成一次文字辨識請求
+"""
+import base64
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from resilience import LatencyTracker
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def sniff_mime(data):
+    """依檔案開頭的特徵位元組判斷圖片格式"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def downscale_image(data, max_side=1600, quality=80):
+    """縮小並重新壓縮為 JPEG；若無法縮小則回傳原圖與原本的格式"""
+    # Pillow 只在處理圖片時才載入，避免拖慢冷啟動
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            source_mime = Image.MIME.get(image.format) or sniff_mime(data)
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+    except (OSError, ValueError) as e:
+        print(f"圖片縮圖失敗，使用原圖: {e}")
+        return data, sniff_mime(data)
+
+    resized = output.getvalue()
+    if len(resized) >= len(data):
+        return data, source_mime
+    return resized, 'image/jpeg'
+
+
+class OpenAIVisionBackend:
+    """以 OpenAI 視覺模型辨識圖片文字，一批圖片只送出一次請求"""
+
+    SEPARATOR = "=== 圖片 {index} ==="
+
+    def __init__(self, openai_client, model=None):
+        self.openai_client = openai_client
+        self.model = model or os.getenv('OPENAI_VISION_MODEL', 'gpt-4o-mini')
+
+    def extract(self, images):
+        prompt = f"""以下共有 {len(images)} 張圖片（可能是白板、投影片或紙本議程）。
+請逐張完整擷取圖片中的文字，保留原本的條列與段落結構，無法辨識的部分標示為 [無法辨識]。
+每張圖片的結果請以「{self.SEPARATOR.format(index='N')}」開頭（N 為圖片編號），不要加入其他說明。"""
+        content = [{"type": "text", "text": prompt}]
+        for image in images:
+            encoded = base64.b64encode(image['data']).decode('ascii')
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{image['mime']};base64,{encoded}"}
+            })
+
+        response = self.openai_client.chat_completion(
+            endpoint='vision',
+            model=self.model,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=1500,
+            temperature=0
+        )
+        return self.split_results(response.choices[0].message.content, len(images))
+
+    def split_results(self, text, count):
+        """依分隔標記拆回每張圖片的文字"""
+        results = []
+        for index in range(1, count + 1):
+            marker = self.SEPARATOR.format(index=index)
+            start = text.find(marker)
+            if start < 0:
+                results.append("")
+                continue
+            start += len(marker)
+            end = text.find(self.SEPARATOR.format(index=index + 1), start)
+            results.append(text[start:end if end >= 0 else None].strip())
+
+        # 模型沒有照格式回應時，整段歸給第一張圖片
+        if not any(results) and text.strip():
+            results[0] = text.strip()
+        return results
+
+
+class StubVisionBackend:
+    """本機模擬辨識結果，用於開發與測試"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def extract(self, images):
+        if self.latency:
+            time.sleep(self.latency)
+        return [f"（模擬辨識結果）第 {i+1} 張圖片，{len(image['data'])} bytes" for i, image in enumerate(images)]
+
+
+def create_backend(name, openai_client):
+    """依名稱建立辨識後端（openai 或 stub）"""
+    if name == 'stub':
+        return StubVisionBackend()
+    if name == 'openai':
+        return OpenAIVisionBackend(openai_client)
+    raise ValueError(f"未知的圖片辨識後端: {name}")
+
+
+class ImagePipeline:
+    """
+    收集同一用戶在 window 秒內傳送的圖片，合併成一次辨識請求
+    fetch_content(message_id) 需回傳具有 iter_content() 的物件（LINE 的 get_message_content）
+    on_batch(user_id, results, error) 在辨識完成後呼叫，results 為每張圖片的 dict，
+    error 為整批辨識失敗時的錯誤訊息
+    """
+
+    def __init__(self, backend, fetch_content, on_batch, window=8, max_batch=6,
+                 max_side=1600, quality=80, workers=4):
+        self.backend = backend
+        self.fetch_content = fetch_content
+        self.on_batch = on_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.max_side = max_side
+        self.quality = quality
+        self.pending = {}  # user_id -> {'images': [...], 'timer': Timer}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self.image_latency = LatencyTracker()
+        self.batch_latency = LatencyTracker()
+        self.counters = {'images': 0, 'batches': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def submit(self, user_id, message_id):
+        """加入一張圖片，回傳是否為新批次的第一張"""
+        received_at = time.time()
+        future = self._pool.submit(self._prepare, message_id)
+        with self._lock:
+            batch = self.pending.get(user_id)
+            is_new = batch is None
+            if is_new:
+                batch = {'images': []}
+                self.pending[user_id] = batch
+            else:
+                batch['timer'].cancel()
+            batch['images'].append({'message_id': message_id, 'future': future, 'received_at': received_at})
+
+            if len(batch['images']) >= self.max_batch:
+                del self.pending[user_id]
+                # 另開執行緒等待，避免佔用前處理的執行緒池
+                threading.Thread(target=self._flush, args=(user_id, batch), daemon=True).start()
+            else:
+                # 每收到一張就重新計時，等用戶傳完
+                batch['timer'] = threading.Timer(self.window, self._expire, args=(user_id, batch))
+                batch['timer'].daemon = True
+                batch['timer'].start()
+        return is_new
+
+    def _expire(self, user_id, batch):
+        with self._lock:
+            if self.pending.get(user_id) is not batch:
+                return
+            del self.pending[user_id]
+        self._flush(user_id, batch)
+
+    def _prepare(self, message_id):
+        """串流下載並縮圖（在執行緒池中執行）"""
+        start = time.time()
+        buffer = io.BytesIO()
+        for chunk in self.fetch_content(message_id).iter_content(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+        original = buffer.getvalue()
+
+        data, mime = downscale_image(original, self.max_side, self.quality)
+        elapsed = time.time() - start
+        print(f"圖片 {message_id} 縮圖完成：{len(original)/1024:.0f}KB → {len(data)/1024:.0f}KB，{elapsed*1000:.0f} ms")
+        return {'data': data, 'mime': mime, 'original_size': len(original), 'prepare_time': elapsed}
+
+    def _flush(self, user_id, batch):
+        """等待所有圖片前處理完成後送出一次辨識請求"""
+        images = []
+        results = []
+        for item in batch['images']:
+            result = {'message_id': item['message_id'], 'received_at': item['received_at']}
+            try:
+                result.update(item['future'].result())
+                images.append(result)
+            except Exception as e:
+                print(f"圖片 {item['message_id']} 下載或縮圖失敗: {e}")
+                result['error'] = str(e)
+            results.append(result)
+
+        start = time.time()
+        error = None
+        if images:
+            try:
+                texts = self.backend.extract(images)
+                for image, text in zip(images, texts):
+                    image['text'] = text
+            except Exception as e:
+                print(f"圖片辨識失敗: {e}")
+                error = str(e)
+        done = time.time()
+
+        with self._lock:
+            self.counters['batches'] += 1
+            self.counters['images'] += len(images)
+            self.counters['failed'] += len(results) - len(images)
+            for image in images:
+                self.counters['bytes_in'] += image['original_size']
+                self.counters['bytes_out'] += len(image['data'])
+        self.batch_latency.record(done - start)
+        for image in images:
+            # 單張圖片延遲：從收到事件到辨識完成
+            image['latency'] = done - image['received_at']
+            self.image_latency.record(image['latency'])
+            # 結果只保留統計資料，不再持有圖片內容
+            image['size'] = len(image.pop('data'))
+
+        try:
+            self.on_batch(user_id, results, error)
+        except Exception as e:
+            print(f"圖片結果發送失敗: {e}")
+
+    def stats(self):
+        """縮圖節省的位元組與延遲統計"""
+        with self._lock:
+            result = dict(self.counters)
+        result['bytes_saved'] = result['bytes_in'] - result['bytes_out']
+        for name, tracker in (('image_latency', self.image_latency), ('batch_latency', self.batch_latency)):
+            p50 = tracker.percentile(50)
+            p95 = tracker.percentile(95)
+            result[name] = {
+                'p50_seconds': round(p50, 3) if p50 is not None else None,
+                'p95_seconds': round(p95, 3) if p95 is not None else None,
+            }
+        return result
@@ -0,0 +1,99 @@
+"""
+文字訊息合併
+用戶常連續傳送多則短訊息，同一用戶在 window 秒內的文字合併成一次模型呼叫，
+並以最後一則訊息的 reply token 回覆
+"""
+import collections
+import threading
+import time
+
+
+class MessageCoalescer:
+    """
+    每收到一則訊息就重新計時；距離第一則超過 max_wait 秒時立即送出，
+    確保回覆時 reply token 仍在有效期限內（LINE 建議收到 webhook 後一分鐘內回覆）
+    on_flush(user_id, texts, reply_token) 在合併完成後於計時器執行緒中呼叫，
+    同一用戶的 on_flush 依序執行（前一批的回應與對話紀錄更新完成後才處理下一批）
+
+    統計只涵蓋 idle_timeout 秒內有傳送訊息的活躍用戶，閒置的用戶會被移除
+    合併狀態保存在行程記憶體中，多個 gunicorn worker 時同一用戶的訊息可能分散在不同 worker
+    """
+
+    def __init__(self, on_flush, window=2.0, max_wait=20.0, idle_timeout=3600):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_wait = max_wait
+        self.idle_timeout = idle_timeout
+        self.pending = {}  # user_id -> {'texts': [...], 'reply_token': str, 'first_at': float, 'timer': Timer}
+        # user_id -> {'events': int, 'llm_calls': int, 'last_seen': float, 'lock': Lock}，依最後活動時間排序
+        self.usage = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, text, reply_token):
+        """加入一則文字訊息"""
+        with self._lock:
+            now = time.time()
+            usage = self.usage.pop(user_id, None) or {'events': 0, 'llm_calls': 0, 'lock': threading.Lock()}
+            usage['events'] += 1
+            usage['last_seen'] = now
+            self.usage[user_id] = usage
+            self._prune(now)
+
+            batch = self.pending.get(user_id)
+            if batch is None:
+                batch = {'texts': [], 'first_at': now}
+                self.pending[user_id] = batch
+            else:
+                batch['timer'].cancel()
+            batch['texts'].append(text)
+            batch['reply_token'] = reply_token
+
+            delay = min(self.window, batch['first_at'] + self.max_wait - now)
+            batch['timer'] = threading.Timer(max(0, delay), self._expire, args=(user_id, batch))
+            batch['timer'].daemon = True
+            batch['timer'].start()
+
+    def _prune(self, now):
+        """移除閒置超過 idle_timeout 的用戶（最久未活動的排在最前面）"""
+        while self.usage:
+            user_id, usage = next(iter(self.usage.items()))
+            if now - usage['last_seen'] < self.idle_timeout or user_id in self.pending or usage['lock'].locked():
+                break
+            del self.usage[user_id]
+
+    def _expire(self, user_id, batch):
+        with self._lock:
+            if self.pending.get(user_id) is not batch:
+                return
+            del self.pending[user_id]
+            usage = self.usage[user_id]
+            usage['llm_calls'] += 1
+
+        if len(batch['texts']) > 1:
+            print(f"合併用戶 {user_id} 的 {len(batch['texts'])} 則訊息")
+        # 前一批仍在等待模型回應時，等它完成再處理，避免同時更新同一用戶的對話紀錄
+        with usage['lock']:
+            try:
+                self.on_flush(user_id, batch['texts'], batch['reply_token'])
+            except Exception as e:
+                print(f"合併訊息回覆失敗: {e}")
+
+    def stats(self):
+        """節省的模型呼叫次數（每位活躍用戶）"""
+        with self._lock:
+            self._prune(time.time())
+            users = len(self.usage)
+            events = sum(usage['events'] for usage in self.usage.values())
+            llm_calls = sum(usage['llm_calls'] for usage in self.usage.values())
+            pending = sum(len(batch['texts']) for batch in self.pending.values())
+        saved = events - pending - llm_calls
+        return {
+            'window_seconds': self.window,
+            'idle_timeout_seconds': self.idle_timeout,
+            'active_users': users,
+            'events': events,
+            'llm_calls': llm_calls,
+            'pending': pending,
+            'llm_calls_saved': saved,
+            'saved_per_active_user': round(saved / users, 2) if users else 0,
+        }
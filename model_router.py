@@ -0,0 +1,160 @@
+"""
+模型路由
+依任務類型與輸入長度選擇模型、max_tokens 與 temperature，
+並追蹤各模型延遲，偏好模型變慢時改用備援模型
+"""
+import collections
+import json
+import os
+import threading
+
+from resilience import LatencyTracker
+
+# 同一任務的路由依序比對，第一個 max_chars 足夠的路由勝出（None 表示不限長度）
+# 輸入長度無法預測回覆長度，對話一律保留系統提示允許的 300 字回覆空間
+# 對話需在 reply token 有效期限內回覆，偏好模型 p95 達到 8 秒時改用備援模型
+DEFAULT_ROUTES = collections.OrderedDict([
+    ('chat', {'task': 'chat', 'max_chars': None, 'model': 'gpt-3.5-turbo',
+              'fallback': 'gpt-4o-mini', 'slo_seconds': 8,
+              'max_tokens': 300, 'temperature': 0.7}),
+    ('summary', {'task': 'summary', 'max_chars': 8000, 'model': 'gpt-3.5-turbo',
+                 'max_tokens': 800, 'temperature': 0.3}),
+    # 長逐字稿超過 gpt-3.5-turbo 的上下文長度，沒有可容納的備援模型
+    ('summary_large', {'task': 'summary', 'max_chars': None, 'model': 'gpt-4o-mini',
+                       'max_tokens': 1200, 'temperature': 0.3}),
+    ('long_summary', {'task': 'long_summary', 'max_chars': None, 'model': 'gpt-3.5-turbo',
+                      'max_tokens': 800, 'temperature': 0.3}),
+])
+
+
+class ModelStats:
+    """單一路由下單一模型的延遲統計（指數移動平均與近期 p95）"""
+
+    def __init__(self, alpha=0.2, window=20):
+        self.alpha = alpha
+        self.ewma = None
+        self.latency = LatencyTracker(size=window)
+
+    def record(self, seconds):
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.latency.record(seconds)
+
+
+class ModelRouter:
+    """
+    路由表可由 MODEL_ROUTES 環境變數覆寫（JSON 字串或 JSON 檔案路徑），與預設值逐項合併：
+        MODEL_ROUTES='{"chat": {"model": "gpt-4o-mini", "fallback": "gpt-3.5-turbo", "slo_seconds": 4}}'
+    設定 fallback 與 slo_seconds 的路由，在偏好模型 p95 達到 slo_seconds 且備援模型平均較快時改用備援，
+    期間每 probe_every 次仍送一次給偏好模型以偵測恢復
+    延遲以 (路由, 模型) 分開統計，避免短對話的延遲影響長摘要的判斷；
+    失敗與逾時的呼叫也計入模型延遲，且至少以 slo_seconds 計，視為一次超標
+    """
+
+    def __init__(self, routes=None, min_samples=10, probe_every=5):
+        self.routes = collections.OrderedDict((name, dict(route)) for name, route in DEFAULT_ROUTES.items())
+        for name, route in (routes or {}).items():
+            self.routes.setdefault(name, {}).update(route)
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.model_stats = collections.defaultdict(ModelStats)  # (route, model) -> ModelStats
+        self.route_stats = collections.defaultdict(collections.Counter)
+        self.route_latency = collections.defaultdict(LatencyTracker)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """由 MODEL_ROUTES 環境變數建立"""
+        environ = os.environ if environ is None else environ
+        config = environ.get('MODEL_ROUTES', '').strip()
+        if config and not config.startswith('{'):
+            with open(config, encoding='utf-8') as f:
+                config = f.read()
+        return cls(json.loads(config) if config else None)
+
+    def classify(self, task, text):
+        """依任務與輸入長度決定路由名稱"""
+        for name, route in self.routes.items():
+            if route.get('task') != task:
+                continue
+            if route.get('max_chars') is None or len(text) <= route['max_chars']:
+                return name
+        raise ValueError(f"找不到任務 {task} 的路由")
+
+    def select(self, task, text):
+        """回傳本次呼叫要使用的路由設定（含實際選用的模型）"""
+        name = self.classify(task, text)
+        route = self.routes[name]
+        model = route['model']
+
+        with self._lock:
+            stats = self.route_stats[name]
+            stats['calls'] += 1
+            if self._should_fall_back(name, route) and stats['calls'] % self.probe_every:
+                model = route['fallback']
+                stats['fallbacks'] += 1
+
+        return {
+            'route': name,
+            'model': model,
+            'max_tokens': route['max_tokens'],
+            'temperature': route['temperature'],
+        }
+
+    def _should_fall_back(self, name, route):
+        fallback = route.get('fallback')
+        if not fallback or not route.get('slo_seconds'):
+            return False
+        preferred = self.model_stats[(name, route['model'])]
+        if len(preferred.latency) < self.min_samples:
+            return False
+        if preferred.latency.percentile(95) < route['slo_seconds']:
+            return False
+        # 備援模型尚無資料時先嘗試，有資料則須平均較快
+        backup = self.model_stats[(name, fallback)]
+        return backup.ewma is None or backup.ewma < preferred.ewma
+
+    def record(self, selection, seconds, usage=None):
+        """記錄一次成功呼叫的延遲與 token 用量"""
+        with self._lock:
+            self.model_stats[(selection['route'], selection['model'])].record(seconds)
+            stats = self.route_stats[selection['route']]
+            if usage:
+                stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+                stats['completion_tokens'] += usage.get('completion_tokens', 0)
+            self.route_latency[selection['route']].record(seconds)
+
+    def record_error(self, selection, seconds=None):
+        """記錄一次失敗呼叫；提供 seconds 時計入該模型的延遲，作為是否改用備援的依據"""
+        with self._lock:
+            self.route_stats[selection['route']]['errors'] += 1
+            if seconds is not None:
+                slo = self.routes[selection['route']].get('slo_seconds') or 0
+                self.model_stats[(selection['route'], selection['model'])].record(max(seconds, slo))
+
+    def stats(self):
+        """各路由的延遲與 token 統計，以及路由下各模型的延遲"""
+        def seconds(value):
+            return round(value, 3) if value is not None else None
+
+        with self._lock:
+            routes = {}
+            for name, route in self.routes.items():
+                counters = dict(self.route_stats[name])
+                tracker = self.route_latency[name]
+                routes[name] = dict(
+                    counters,
+                    model=route['model'],
+                    fallback=route.get('fallback'),
+                    p50_seconds=seconds(tracker.percentile(50)),
+                    p95_seconds=seconds(tracker.percentile(95)),
+                    models={
+                        model: {
+                            'samples': len(stats.latency),
+                            'ewma_seconds': seconds(stats.ewma),
+                            'p95_seconds': seconds(stats.latency.percentile(95)),
+                        }
+                        for (route_name, model), stats in self.model_stats.items()
+                        if route_name == name
+                    },
+                )
+        return {'routes': routes}
@@ -0,0 +1,419 @@
+"""
+OpenAI 呼叫的韌性包裝
+提供各端點逾時、帶抖動的重試（受重試預算限制）、聊天請求的對沖（hedging）與斷路器
+"""
+import collections
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+_openai = None
+
+
+def load_openai():
+    """延遲載入 openai 套件（匯入約需 0.2 秒，不應拖慢冷啟動）"""
+    global _openai
+    if _openai is None:
+        import openai
+        # openai 匯入時才讀取環境變數，若早於 load_dotenv() 匯入則補上
+        openai.api_key = openai.api_key or os.getenv('OPENAI_API_KEY')
+        _openai = openai
+    return _openai
+
+
+def retryable_errors():
+    """視為上游暫時性故障、可以重試的錯誤"""
+    openai_error = load_openai().error
+    return (
+        openai_error.Timeout,
+        openai_error.APIConnectionError,
+        openai_error.RateLimitError,
+        openai_error.ServiceUnavailableError,
+        openai_error.APIError,
+        openai_error.TryAgain,
+    )
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟時直接拒絕請求"""
+
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(f"AI服務暫時無法連線（{endpoint}），約 {retry_after:.0f} 秒後重試")
+
+
+class LatencyTracker:
+    """保留最近的延遲樣本，用來估計 p95"""
+
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class RetryBudget:
+    """
+    重試預算：每次正常請求存入 ratio 個額度，每次重試或對沖扣除 1 個
+    上游故障時重試次數最多約為請求量的 ratio 倍，避免重試風暴
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """連續失敗達門檻後開啟，冷卻後以半開狀態放行一個試探請求"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.recovery_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def retry_after(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.recovery_timeout - (time.time() - self.opened_at))
+
+    def allow_request(self):
+        """是否放行請求；半開狀態下同時只放行一個試探請求"""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                # 試探失敗或連續失敗過多，重新計時
+                self.opened_at = time.time()
+            self._trial_in_flight = False
+
+
+class EndpointPolicy:
+    """單一端點的逾時、重試與統計"""
+
+    def __init__(self, name, timeout, max_retries=2, hedge=False,
+                 failure_threshold=5, recovery_timeout=30):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+        self.latency = LatencyTracker()
+        self.stats = collections.Counter()
+
+
+class ResilientOpenAI:
+    """
+    包裝 openai.ChatCompletion.create 與 openai.Audio.transcribe
+    端點：chat（互動對話）、summary（記錄整理 / 摘要）、audio（語音轉錄）、vision（圖片辨識）
+    """
+
+    def __init__(self, chat_timeout=20, summary_timeout=60, audio_timeout=300, vision_timeout=90,
+                 max_retries=2, hedge_chat=False, retry_ratio=0.2,
+                 failure_threshold=5, recovery_timeout=30,
+                 backoff_base=0.5, backoff_cap=8, hedge_min_samples=20, hedge_default_delay=3,
+                 max_hedges=8):
+        self.endpoints = {
+            'chat': EndpointPolicy('chat', chat_timeout, max_retries, hedge_chat,
+                                   failure_threshold, recovery_timeout),
+            'summary': EndpointPolicy('summary', summary_timeout, max_retries, False,
+                                      failure_threshold, recovery_timeout),
+            'audio': EndpointPolicy('audio', audio_timeout, max_retries, False,
+                                    failure_threshold, recovery_timeout),
+            'vision': EndpointPolicy('vision', vision_timeout, max_retries, False,
+                                     failure_threshold, recovery_timeout),
+        }
+        self.budget = RetryBudget(retry_ratio)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay = hedge_default_delay
+        # 只有對沖請求使用執行緒池；名額用完時不排隊，直接等待主請求
+        self._hedge_pool = ThreadPoolExecutor(max_workers=max_hedges, thread_name_prefix='openai-hedge')
+        self._hedge_slots = threading.BoundedSemaphore(max_hedges)
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """由環境變數建立（OPENAI_CHAT_TIMEOUT、OPENAI_HEDGE_CHAT 等）"""
+        environ = os.environ if environ is None else environ
+        return cls(
+            chat_timeout=float(environ.get('OPENAI_CHAT_TIMEOUT', 20)),
+            summary_timeout=float(environ.get('OPENAI_SUMMARY_TIMEOUT', 60)),
+            audio_timeout=float(environ.get('OPENAI_AUDIO_TIMEOUT', 300)),
+            vision_timeout=float(environ.get('OPENAI_VISION_TIMEOUT', 90)),
+            max_retries=int(environ.get('OPENAI_MAX_RETRIES', 2)),
+            hedge_chat=environ.get('OPENAI_HEDGE_CHAT', '').lower() in ('1', 'true', 'yes'),
+            max_hedges=int(environ.get('OPENAI_MAX_HEDGES', 8)),
+            failure_threshold=int(environ.get('OPENAI_BREAKER_THRESHOLD', 5)),
+            recovery_timeout=float(environ.get('OPENAI_BREAKER_COOLDOWN', 30)),
+        )
+
+    # ---- 公開介面 ----
+
+    def chat_completion(self, endpoint='chat', **kwargs):
+        """呼叫 ChatCompletion，endpoint 為 chat、summary 或 vision"""
+        policy = self.endpoints[endpoint]
+        kwargs.setdefault('request_timeout', policy.timeout)
+        return self._call(policy, lambda: load_openai().ChatCompletion.create(**kwargs))
+
+    def transcribe(self, file, model="whisper-1", **params):
+        """呼叫 Whisper 轉錄，重試前會將檔案指標移回開頭"""
+        policy = self.endpoints['audio']
+
+        def attempt():
+            openai = load_openai()
+            file.seek(0)
+            # openai 0.28 的 Audio.transcribe 不接受 request_timeout，改由 requestor 直接送出
+            requestor, files, data = openai.Audio._prepare_request(
+                file=file, filename=file.name, model=model, **params
+            )
+            url = openai.Audio._get_url("transcriptions")
+            response, _, api_key = requestor.request(
+                "post", url, files=files, params=data, request_timeout=policy.timeout
+            )
+            return openai.util.convert_to_openai_object(response, api_key, None, None)
+
+        return self._call(policy, attempt)
+
+    def warm_up(self):
+        """預先載入 openai 套件（由 gunicorn 主行程在 fork 前呼叫）"""
+        load_openai()
+
+    def is_available(self, endpoint):
+        """端點的斷路器是否允許請求（不佔用半開試探名額）"""
+        return self.endpoints[endpoint].breaker.state != CircuitBreaker.OPEN
+
+    def is_closed(self, endpoint):
+        """端點的斷路器是否已完全恢復（半開試探尚未成功時也回傳 False）"""
+        return self.endpoints[endpoint].breaker.state == CircuitBreaker.CLOSED
+
+    def wait_until_available(self, endpoint, poll_interval=5):
+        """阻塞直到端點的斷路器離開開啟狀態"""
+        breaker = self.endpoints[endpoint].breaker
+        while breaker.state == CircuitBreaker.OPEN:
+            time.sleep(max(0.1, min(poll_interval, breaker.retry_after())))
+
+    def stats(self):
+        """各端點的統計資料"""
+        result = {'retry_budget': round(self.budget.tokens, 2)}
+        for name, policy in self.endpoints.items():
+            p95 = policy.latency.percentile(95)
+            result[name] = dict(policy.stats)
+            result[name].update(
+                state=policy.breaker.state,
+                timeout=policy.timeout,
+                p95_seconds=round(p95, 3) if p95 is not None else None,
+            )
+        return result
+
+    # ---- 內部實作 ----
+
+    def _call(self, policy, func):
+        self.budget.deposit()
+        policy.stats['calls'] += 1
+        retryable = retryable_errors()
+        last_error = None
+
+        for attempt in range(policy.max_retries + 1):
+            if attempt > 0:
+                if not self.budget.withdraw():
+                    policy.stats['budget_exhausted'] += 1
+                    break
+                policy.stats['retries'] += 1
+                # full jitter 指數退避
+                time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+
+            if not policy.breaker.allow_request():
+                policy.stats['rejected'] += 1
+                raise CircuitOpenError(policy.name, policy.breaker.retry_after())
+
+            start = time.time()
+            try:
+                if policy.hedge:
+                    result = self._hedged(policy, func)
+                else:
+                    result = func()
+            except retryable as e:
+                policy.breaker.record_failure()
+                policy.stats['failures'] += 1
+                print(f"OpenAI {policy.name} 第 {attempt + 1} 次呼叫失敗: {e}")
+                last_error = e
+                continue
+            except Exception:
+                # 請求本身有誤（例如參數錯誤），上游仍正常
+                policy.breaker.record_success()
+                raise
+
+            policy.latency.record(time.time() - start)
+            policy.breaker.record_success()
+            return result
+
+        raise last_error
+
+    def _hedge_delay(self, policy):
+        if len(policy.latency) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return policy.latency.percentile(95)
+
+    @staticmethod
+    def _run_in_thread(func):
+        """在獨立執行緒執行 func，回傳 Future（主請求不與其他呼叫共用執行緒池，不會排隊）"""
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def _hedged(self, policy, func):
+        """先送出主請求，超過 p95 仍未完成時送出第二個請求，採用先成功者"""
+        primary = self._run_in_thread(func)
+        done, _ = wait([primary], timeout=self._hedge_delay(policy))
+        if done:
+            return primary.result()
+        if not self._hedge_slots.acquire(blocking=False):
+            # 對沖名額已滿（上游普遍變慢），排隊送出只會更慢
+            policy.stats['hedges_skipped'] += 1
+            return primary.result()
+        if not self.budget.withdraw():
+            self._hedge_slots.release()
+            return primary.result()
+
+        policy.stats['hedges'] += 1
+        secondary = self._hedge_pool.submit(func)
+        secondary.add_done_callback(lambda _: self._hedge_slots.release())
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is secondary:
+                        policy.stats['hedge_wins'] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+
+class DeferredJobQueue:
+    """
+    斷路器開啟時暫存音頻工作，上游恢復後依序執行
+    工作回傳 False 或因上游故障拋出例外時放回佇列最前面，等斷路器再次放行後重試
+    """
+
+    def __init__(self, client, endpoint='audio', retry_delay=5):
+        self.client = client
+        self.endpoint = endpoint
+        self.retry_delay = retry_delay
+        self.jobs = collections.deque()
+        self.requeued = 0
+        self._condition = threading.Condition()
+        self._worker = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def submit(self, func, *args, **kwargs):
+        with self._condition:
+            self.jobs.append((func, args, kwargs))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._condition.notify()
+        return len(self.jobs)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.jobs:
+                    self._condition.wait()
+            self.client.wait_until_available(self.endpoint)
+            with self._condition:
+                job = self.jobs.popleft()
+
+            func, args, kwargs = job
+            try:
+                done = func(*args, **kwargs) is not False
+            except (CircuitOpenError,) + retryable_errors() as e:
+                print(f"上游仍無法連線: {e}")
+                done = False
+            except Exception as e:
+                print(f"佇列中的音頻工作執行失敗: {e}")
+                done = True
+
+            if not done:
+                # 半開試探失敗時斷路器會重新開啟，下一輪 wait_until_available 會等待冷卻
+                with self._condition:
+                    self.jobs.appendleft(job)
+                    self.requeued += 1
+                print(f"音頻工作重新排入佇列（佇列中 {len(self.jobs)} 個）")
+                time.sleep(self.retry_delay)
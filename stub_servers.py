@@ -0,0 +1,268 @@
+"""
+本機模擬 API 伺服器
+用於離線批次轉錄、基準測試與開發，不會呼叫真正的 OpenAI / LINE 服務
+支援延遲與錯誤注入，可用來驗證逾時、重試、對沖與斷路器行為
+
+使用方式：
+    python stub_servers.py --port 8090
+    python stub_servers.py --port 8090 --error-rate 0.3 --slow-rate 0.05 --slow-latency 10
+    python stub_servers.py --line --port 8091
+    python batch_transcribe.py recordings/ --api-base http://127.0.0.1:8090/v1
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAULT_SETTINGS = ('latency', 'error_rate', 'error_status', 'slow_rate', 'slow_latency', 'fault_path')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模擬伺服器共用的請求處理"""
+
+    def log_message(self, format, *args):
+        # 靜音預設的存取紀錄
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self._send_bytes(status, body, 'application/json')
+
+    def _send_bytes(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _inject_fault(self):
+        """依設定延遲並回傳錯誤，回傳 True 表示已送出錯誤回應"""
+        delay, error_status = self.server.draw_fault(self.path)
+        if delay:
+            time.sleep(delay)
+        if error_status:
+            self._send_json(error_status, {"error": {"message": "模擬上游錯誤", "type": "server_error"}})
+            return True
+        return False
+
+
+class StubOpenAIHandler(StubHandler):
+    """模擬 OpenAI 的 chat completions 與 audio transcriptions 端點"""
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.record_call(self.path)
+        if self._inject_fault():
+            return
+
+        if self.path.endswith('/chat/completions'):
+            try:
+                request_data = json.loads(body or b"{}")
+            except ValueError:
+                request_data = {}
+            self._send_json(200, self.server.chat_response(request_data))
+        elif self.path.endswith('/audio/transcriptions'):
+            self._send_json(200, {"text": f"（模擬轉錄內容，{len(body)} bytes）"})
+        else:
+            self._send_json(404, {"error": {"message": f"未知端點: {self.path}"}})
+
+
+class StubLineHandler(StubHandler):
+    """模擬 LINE Messaging API 的 reply、push 與內容下載端點"""
+
+    CONTENT_PATH = re.compile(r'^/v2/bot/message/([^/]+)/content$')
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.record_call(self.path)
+        if self._inject_fault():
+            return
+
+        try:
+            request_data = json.loads(body or b"{}")
+        except ValueError:
+            request_data = {}
+
+        if self.path == '/v2/bot/message/reply':
+            self.server.record_delivery('reply', request_data.get('replyToken'), request_data.get('messages'))
+            self._send_json(200, {})
+        elif self.path == '/v2/bot/message/push':
+            self.server.record_delivery('push', request_data.get('to'), request_data.get('messages'))
+            self._send_json(200, {})
+        else:
+            self._send_json(404, {"message": f"未知端點: {self.path}"})
+
+    def do_GET(self):
+        match = self.CONTENT_PATH.match(self.path)
+        self.server.record_call('/v2/bot/message/{id}/content' if match else self.path)
+        if self._inject_fault():
+            return
+
+        content = self.server.contents.get(match.group(1)) if match else None
+        if content is None:
+            self._send_json(404, {"message": "Not found"})
+            return
+        self._send_bytes(200, content, 'application/octet-stream')
+
+
+class StubServer(ThreadingHTTPServer):
+    """帶有呼叫計數與故障注入的模擬伺服器"""
+
+    daemon_threads = True
+
+    def __init__(self, address, handler_class, latency=0.0, **faults):
+        super().__init__(address, handler_class)
+        self.latency = latency
+        self.error_rate = 0.0
+        self.error_status = 503
+        self.slow_rate = 0.0
+        self.slow_latency = 0.0
+        self.fault_path = None
+        self.configure(**faults)
+        self.calls = {}
+        self.last_activity = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def configure(self, **faults):
+        """
+        調整故障注入設定，執行中也可以呼叫
+        latency: 基本延遲；error_rate / error_status: 回傳錯誤的比例與狀態碼；
+        slow_rate / slow_latency: 長尾請求的比例與額外延遲；
+        fault_path: 只對路徑結尾相符的請求注入故障（例如 /chat/completions），None 表示全部
+        """
+        for name, value in faults.items():
+            if name not in FAULT_SETTINGS:
+                raise ValueError(f"未知的故障設定: {name}")
+            setattr(self, name, value)
+
+    def draw_fault(self, path):
+        """決定本次請求的延遲與錯誤狀態碼（0 表示正常回應）"""
+        if self.fault_path and not path.endswith(self.fault_path):
+            return 0.0, 0
+        delay = self.latency
+        if self.slow_rate and random.random() < self.slow_rate:
+            delay += self.slow_latency
+        error_status = self.error_status if self.error_rate and random.random() < self.error_rate else 0
+        return delay, error_status
+
+    def record_call(self, path):
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            self.last_activity = time.time()
+
+
+class StubOpenAIServer(StubServer):
+    """模擬 OpenAI 伺服器"""
+
+    def __init__(self, address, latency=0.0, **faults):
+        super().__init__(address, StubOpenAIHandler, latency=latency, **faults)
+
+    @property
+    def api_base(self):
+        return f"{self.base_url}/v1"
+
+    def chat_response(self, request_data):
+        messages = request_data.get('messages') or [{}]
+        last = messages[-1].get('content', '')
+        content = f"（模擬回應）{str(last)[:50]}"
+        # 粗估 token 數：中文約每 2 字一個 token
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in messages) // 2
+        completion_tokens = min(len(content) // 2, request_data.get('max_tokens') or len(content))
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request_data.get('model', 'gpt-3.5-turbo'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+
+class StubLineServer(StubServer):
+    """
+    模擬 LINE Messaging API 伺服器（同時作為 api 與 api-data 端點）
+    contents: message_id -> 下載內容；deliveries: 依序記錄每則 reply / push
+    """
+
+    def __init__(self, address, latency=0.0, **faults):
+        super().__init__(address, StubLineHandler, latency=latency, **faults)
+        self.contents = {}
+        self.deliveries = []
+
+    def record_delivery(self, kind, target, messages):
+        with self._lock:
+            self.deliveries.append({
+                'time': time.time(),
+                'kind': kind,
+                'target': target,
+                'texts': [message.get('text') for message in messages or []]
+            })
+
+
+def _serve_in_background(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def start_stub_openai(host='127.0.0.1', port=0, latency=0.0, **faults):
+    """在背景執行緒啟動模擬 OpenAI 伺服器，回傳伺服器實例"""
+    return _serve_in_background(StubOpenAIServer((host, port), latency=latency, **faults))
+
+
+def start_stub_line(host='127.0.0.1', port=0, latency=0.0, **faults):
+    """在背景執行緒啟動模擬 LINE 伺服器，回傳伺服器實例"""
+    return _serve_in_background(StubLineServer((host, port), latency=latency, **faults))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="啟動本機模擬 OpenAI / LINE API")
+    parser.add_argument('--line', action='store_true', help="啟動 LINE 模擬伺服器（預設為 OpenAI）")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0, help="每次請求的模擬延遲（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="回傳錯誤的比例（0~1）")
+    parser.add_argument('--error-status', type=int, default=503, help="注入錯誤的 HTTP 狀態碼")
+    parser.add_argument('--slow-rate', type=float, default=0.0, help="長尾請求的比例（0~1）")
+    parser.add_argument('--slow-latency', type=float, default=0.0, help="長尾請求的額外延遲（秒）")
+    parser.add_argument('--fault-path', help="只對此路徑結尾的請求注入故障（例如 /chat/completions）")
+    args = parser.parse_args()
+
+    server_class = StubLineServer if args.line else StubOpenAIServer
+    server = server_class(
+        (args.host, args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        fault_path=args.fault_path
+    )
+    if args.line:
+        print(f"🧪 模擬 LINE API: {server.base_url}")
+    else:
+        print(f"🧪 模擬 OpenAI API: {server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,26 @@
+"""
+測試共用設定：OpenAI 呼叫改送往本機模擬伺服器（stub_servers.py）
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resilience import load_openai  # noqa: E402
+from stub_servers import start_stub_openai  # noqa: E402
+
+
+@pytest.fixture
+def stub_openai():
+    """啟動可注入故障的模擬 OpenAI 伺服器，並讓 openai 套件指向它"""
+    server = start_stub_openai()
+    openai = load_openai()
+    previous = (openai.api_base, openai.api_key)
+    openai.api_base = server.api_base
+    openai.api_key = 'test'
+    yield server
+    openai.api_base, openai.api_key = previous
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,71 @@
+import json
+import os
+import wave
+
+import pytest
+
+import batch_transcribe
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    """兩個短的靜音 WAV 檔"""
+    folder = tmp_path / 'recordings'
+    folder.mkdir()
+    for name, seconds in (('weekly.wav', 2), ('client.wav', 3)):
+        with wave.open(str(folder / name), 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(16000)
+            wav_file.writeframes(b"\0\0" * 16000 * seconds)
+    return folder
+
+
+@pytest.fixture(autouse=True)
+def fresh_processor(monkeypatch):
+    # 不重試，讓注入的錯誤立即反映在結果上
+    monkeypatch.setenv('OPENAI_MAX_RETRIES', '0')
+    monkeypatch.setattr(batch_transcribe, '_processor', None)
+
+
+def run(stub, recordings, output_dir):
+    return batch_transcribe.main([
+        str(recordings), '--output-dir', str(output_dir), '--workers', '1', '--api-base', stub.api_base
+    ])
+
+
+def read_records(output_dir):
+    with open(os.path.join(output_dir, 'results.jsonl'), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_rerun_skips_completed_files(stub_openai, recordings, tmp_path):
+    output_dir = tmp_path / 'output'
+    assert run(stub_openai, recordings, output_dir) == 0
+
+    records = read_records(output_dir)
+    assert sorted(record['filename'] for record in records) == ['client.wav', 'weekly.wav']
+    assert all(record['status'] == 'completed' for record in records)
+    assert all(os.path.exists(record['markdown']) for record in records)
+
+    calls = dict(stub_openai.calls)
+    assert run(stub_openai, recordings, output_dir) == 0
+    assert stub_openai.calls == calls
+    assert len(read_records(output_dir)) == 2
+
+
+def test_failed_summary_is_retried_on_next_run(stub_openai, recordings, tmp_path):
+    output_dir = tmp_path / 'output'
+    stub_openai.configure(error_rate=1.0, fault_path='/chat/completions')
+    assert run(stub_openai, recordings, output_dir) == 1
+
+    records = read_records(output_dir)
+    assert [record['status'] for record in records] == ['failed', 'failed']
+    assert all("摘要失敗" in record['error'] for record in records)
+
+    # 上游恢復後重新執行，兩個檔案都會再處理一次
+    stub_openai.configure(error_rate=0)
+    assert run(stub_openai, recordings, output_dir) == 0
+    completed = [record for record in read_records(output_dir) if record['status'] == 'completed']
+    assert sorted(record['filename'] for record in completed) == ['client.wav', 'weekly.wav']
+    assert all(not record['summary'].startswith("記錄整理失敗") for record in completed)
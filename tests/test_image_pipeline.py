@@ -0,0 +1,110 @@
+import io
+import queue
+
+import pytest
+from PIL import Image
+
+from image_pipeline import ImagePipeline, OpenAIVisionBackend, StubVisionBackend, downscale_image
+
+
+def encode(image_format, size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('image_format, mime', [
+    ('PNG', 'image/png'), ('WEBP', 'image/webp'), ('GIF', 'image/gif'), ('JPEG', 'image/jpeg'),
+])
+def test_original_bytes_keep_their_format(image_format, mime):
+    data = encode(image_format)
+    # 小圖重新壓縮通常不會變小，回傳原圖時須標示原本的格式
+    assert downscale_image(data)[1] == mime
+    # 無法解碼時同樣以檔案開頭判斷格式
+    assert downscale_image(data[:20]) == (data[:20], mime)
+
+
+def test_large_image_is_reencoded_as_jpeg():
+    buffer = io.BytesIO()
+    Image.effect_noise((2000, 1500), 40).convert('RGB').save(buffer, format='PNG')
+    data, mime = downscale_image(buffer.getvalue(), max_side=800)
+    assert mime == 'image/jpeg'
+    assert len(data) < len(buffer.getvalue())
+
+
+class FakeContent:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+@pytest.fixture
+def photo():
+    buffer = io.BytesIO()
+    Image.effect_noise((400, 300), 40).convert('RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_pipeline(photo, **options):
+    batches = queue.Queue()
+    pipeline = ImagePipeline(
+        StubVisionBackend(),
+        lambda message_id: FakeContent(photo),
+        lambda user_id, results, error: batches.put((user_id, results, error)),
+        max_side=100, **options
+    )
+    return pipeline, batches
+
+
+def test_images_within_window_are_sent_as_one_batch(photo):
+    pipeline, batches = make_pipeline(photo, window=0.2)
+    # 只有每批的第一張回傳 True（用來決定是否回覆「處理中」）
+    assert [pipeline.submit('U1', str(i)) for i in range(3)] == [True, False, False]
+
+    user_id, results, error = batches.get(timeout=5)
+    assert user_id == 'U1' and error is None
+    assert [result['message_id'] for result in results] == ['0', '1', '2']
+    assert all(result['text'] for result in results)
+    assert batches.empty()
+    assert pipeline.stats()['batches'] == 1
+
+
+def test_max_batch_forces_a_flush(photo):
+    pipeline, batches = make_pipeline(photo, window=30, max_batch=2)
+    assert [pipeline.submit('U1', str(i)) for i in range(3)] == [True, False, True]
+
+    # 不需等待 window，達到 max_batch 就送出
+    user_id, results, error = batches.get(timeout=5)
+    assert [result['message_id'] for result in results] == ['0', '1']
+    assert [image['message_id'] for image in pipeline.pending['U1']['images']] == ['2']
+    pipeline.pending['U1']['timer'].cancel()
+
+
+def test_stats_report_bytes_saved_and_image_latency(photo):
+    pipeline, batches = make_pipeline(photo, window=0.1)
+    pipeline.submit('U1', '1')
+    pipeline.submit('U1', '2')
+    batches.get(timeout=5)
+
+    stats = pipeline.stats()
+    assert stats['images'] == 2
+    assert stats['bytes_in'] == 2 * len(photo)
+    assert 0 < stats['bytes_saved'] < stats['bytes_in']
+    # 單張延遲從收到事件起算，至少包含合併等待時間
+    assert stats['image_latency']['p95_seconds'] >= 0.1
+    assert stats['batch_latency']['p50_seconds'] is not None
+
+
+def test_split_results_by_separator():
+    backend = OpenAIVisionBackend(openai_client=None, model='test')
+    text = "=== 圖片 1 ===\n第一頁議程\n\n=== 圖片 2 ===\n白板內容"
+    assert backend.split_results(text, 3) == ["第一頁議程", "白板內容", ""]
+
+
+def test_split_results_when_model_ignores_format():
+    backend = OpenAIVisionBackend(openai_client=None, model='test')
+    assert backend.split_results("  只有一段文字  ", 2) == ["只有一段文字", ""]
+    assert backend.split_results("", 2) == ["", ""]
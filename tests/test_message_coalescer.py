@@ -0,0 +1,55 @@
+import threading
+import time
+
+from message_coalescer import MessageCoalescer
+
+
+def test_burst_is_flushed_once_with_last_reply_token():
+    flushed = []
+    done = threading.Event()
+
+    def on_flush(user_id, texts, reply_token):
+        flushed.append((user_id, texts, reply_token))
+        done.set()
+
+    coalescer = MessageCoalescer(on_flush, window=0.05)
+    for i in range(3):
+        coalescer.submit('U1', f"訊息 {i}", f"token-{i}")
+    assert done.wait(2)
+    assert flushed == [('U1', ["訊息 0", "訊息 1", "訊息 2"], 'token-2')]
+    assert coalescer.stats()['llm_calls_saved'] == 2
+
+
+def test_flushes_for_the_same_user_do_not_overlap():
+    running = []
+    overlaps = []
+    finished = []
+
+    def on_flush(user_id, texts, reply_token):
+        running.append(user_id)
+        if len(running) > 1:
+            overlaps.append(texts)
+        time.sleep(0.2)
+        running.remove(user_id)
+        finished.append(texts)
+
+    coalescer = MessageCoalescer(on_flush, window=0.02)
+    coalescer.submit('U1', "第一批", 'token-1')
+    time.sleep(0.1)
+    # 第一批仍在等待模型回應時送出第二批
+    coalescer.submit('U1', "第二批", 'token-2')
+    time.sleep(0.6)
+    assert finished == [["第一批"], ["第二批"]]
+    assert overlaps == []
+
+
+def test_idle_users_are_not_counted_as_active():
+    coalescer = MessageCoalescer(lambda *args: None, window=0.01, idle_timeout=0.2)
+    coalescer.submit('U1', "早安", 'token-1')
+    time.sleep(0.3)
+    coalescer.submit('U2', "午安", 'token-2')
+    time.sleep(0.05)
+    stats = coalescer.stats()
+    assert stats['active_users'] == 1
+    assert stats['events'] == 1
+    assert list(coalescer.usage) == ['U2']
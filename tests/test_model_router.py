@@ -0,0 +1,62 @@
+from model_router import ModelRouter
+
+
+def test_short_chat_keeps_full_reply_budget():
+    selection = ModelRouter().select('chat', "幫我寫一份週會的會議紀錄範本")
+    assert selection['route'] == 'chat'
+    assert selection['max_tokens'] == 300
+
+
+def test_fallback_compares_latency_within_the_same_route():
+    router = ModelRouter({
+        'chat': {'model': 'gpt-4o-mini'},
+        'summary': {'fallback': 'gpt-4o-mini', 'slo_seconds': 5},
+    }, min_samples=3)
+    # 備援模型在對話路由很快，但在摘要路由比偏好模型慢
+    for _ in range(10):
+        router.record({'route': 'chat', 'model': 'gpt-4o-mini'}, 0.5)
+    for _ in range(5):
+        router.record({'route': 'summary', 'model': 'gpt-3.5-turbo'}, 10)
+    router.record({'route': 'summary', 'model': 'gpt-4o-mini'}, 20)
+
+    models = {router.select('summary', "會議逐字稿")['model'] for _ in range(10)}
+    assert models == {'gpt-3.5-turbo'}
+    assert set(router.stats()['routes']['summary']['models']) == {'gpt-3.5-turbo', 'gpt-4o-mini'}
+
+
+def slow_chat_router(seconds):
+    router = ModelRouter(min_samples=3, probe_every=5)
+    for _ in range(5):
+        router.record({'route': 'chat', 'model': 'gpt-3.5-turbo'}, seconds)
+    return router
+
+
+def test_chat_ships_with_fallback_and_slo():
+    route = ModelRouter().routes['chat']
+    assert route['fallback'] and route['slo_seconds']
+
+
+def test_chat_falls_back_once_preferred_p95_exceeds_slo():
+    router = slow_chat_router(3)
+    assert router.select('chat', "你好")['model'] == 'gpt-3.5-turbo'
+
+    router = slow_chat_router(30)
+    selection = router.select('chat', "你好")
+    assert selection['model'] == 'gpt-4o-mini'
+    assert router.stats()['routes']['chat']['fallbacks'] == 1
+
+
+def test_every_probe_still_goes_to_preferred_model():
+    router = slow_chat_router(30)
+    models = [router.select('chat', "你好")['model'] for _ in range(10)]
+    assert [i for i, model in enumerate(models, 1) if model == 'gpt-3.5-turbo'] == [5, 10]
+
+
+def test_failed_calls_count_as_slo_breaches():
+    router = ModelRouter(min_samples=3)
+    selection = {'route': 'chat', 'model': 'gpt-3.5-turbo'}
+    # 連線錯誤很快就失敗，仍須視為超標，而不是拉低延遲
+    for _ in range(5):
+        router.record_error(selection, 0.1)
+    assert router.select('chat', "你好")['model'] == 'gpt-4o-mini'
+    assert router.stats()['routes']['chat']['errors'] == 5
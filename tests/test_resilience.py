@@ -0,0 +1,174 @@
+import threading
+import time
+
+import pytest
+
+from audio_processor import LongAudioProcessor
+from resilience import CircuitBreaker, CircuitOpenError, DeferredJobQueue, ResilientOpenAI, RetryBudget, load_openai
+
+
+def make_client(**options):
+    settings = dict(max_retries=2, backoff_base=0.01, backoff_cap=0.05,
+                    failure_threshold=100, recovery_timeout=30)
+    settings.update(options)
+    return ResilientOpenAI(**settings)
+
+
+def chat(client):
+    return client.chat_completion(
+        model='gpt-3.5-turbo',
+        messages=[{"role": "user", "content": "幫我規劃明天的工作"}],
+        max_tokens=50
+    )
+
+
+def chat_calls(server):
+    return server.calls.get('/v1/chat/completions', 0)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_retry_stops_when_budget_is_exhausted(stub_openai):
+    stub_openai.configure(error_rate=1.0)
+    client = make_client(max_retries=3)
+    client.budget = RetryBudget(ratio=0, max_tokens=1)
+
+    with pytest.raises(load_openai().error.ServiceUnavailableError):
+        chat(client)
+
+    # 一次原始請求加上預算允許的一次重試
+    assert chat_calls(stub_openai) == 2
+    stats = client.stats()['chat']
+    assert stats['retries'] == 1
+    assert stats['budget_exhausted'] == 1
+
+
+def test_hedged_request_wins_when_primary_is_slow(stub_openai):
+    stub_openai.configure(latency=2.0)
+    client = make_client(hedge_chat=True, hedge_default_delay=0.2)
+
+    def speed_up_after_primary():
+        wait_for(lambda: chat_calls(stub_openai) >= 1)
+        # 等主請求決定延遲後，讓對沖請求正常回應
+        time.sleep(0.05)
+        stub_openai.configure(latency=0)
+
+    threading.Thread(target=speed_up_after_primary, daemon=True).start()
+    start = time.time()
+    response = chat(client)
+
+    assert response.choices[0].message.content
+    assert time.time() - start < 1.5
+    assert chat_calls(stub_openai) == 2
+    stats = client.stats()['chat']
+    assert stats['hedges'] == 1
+    assert stats['hedge_wins'] == 1
+
+
+def test_breaker_opens_half_opens_and_recovers(stub_openai):
+    stub_openai.configure(error_rate=1.0)
+    client = make_client(max_retries=0, failure_threshold=2, recovery_timeout=0.3)
+    breaker = client.endpoints['chat'].breaker
+    upstream_error = load_openai().error.ServiceUnavailableError
+
+    for _ in range(2):
+        with pytest.raises(upstream_error):
+            chat(client)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # 開啟期間直接拒絕，不送出請求
+    with pytest.raises(CircuitOpenError):
+        chat(client)
+    assert chat_calls(stub_openai) == 2
+
+    time.sleep(0.35)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 試探請求失敗時重新開啟
+    with pytest.raises(upstream_error):
+        chat(client)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.35)
+    stub_openai.configure(error_rate=0)
+    assert chat(client).choices[0].message.content
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_deferred_queue_drains_after_upstream_recovers(stub_openai):
+    stub_openai.configure(error_rate=1.0)
+    client = make_client(max_retries=0, failure_threshold=1, recovery_timeout=0.2)
+    with pytest.raises(load_openai().error.ServiceUnavailableError):
+        chat(client)
+
+    queue = DeferredJobQueue(client, endpoint='chat', retry_delay=0.01)
+    results = []
+    queue.submit(lambda: results.append(chat(client)))
+
+    # 半開試探失敗時工作放回佇列，不會遺失
+    assert wait_for(lambda: queue.requeued >= 1)
+    assert not results
+
+    stub_openai.configure(error_rate=0)
+    assert wait_for(lambda: results)
+    assert len(queue) == 0
+
+
+def test_queued_long_audio_is_deferred_while_upstream_is_down(stub_openai):
+    stub_openai.configure(error_rate=1.0)
+    client = make_client(max_retries=0, failure_threshold=1)
+    pushed = []
+
+    class RecordingLineBotApi:
+        def push_message(self, user_id, message):
+            pushed.append(message.text)
+
+    processor = LongAudioProcessor(openai_client=client, get_line_bot_api=RecordingLineBotApi)
+
+    transcript, error = processor.transcribe_audio_chunks([b"\0" * 1024], 'meeting.m4a')
+    assert transcript is None
+    assert "轉錄失敗" in error
+
+    # 佇列中的工作不通知失敗，回傳 False 讓佇列重新排入
+    assert processor.process_long_audio_async('U1', b"\0" * 1024, 'meeting.m4a', '1', defer_on_outage=True) is False
+    assert pushed == []
+
+
+def test_hedged_primaries_do_not_queue_behind_each_other(stub_openai):
+    stub_openai.configure(latency=0.3)
+    client = make_client(hedge_chat=True, hedge_default_delay=5, max_hedges=2)
+
+    start = time.time()
+    threads = [threading.Thread(target=chat, args=(client,)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 20 個主請求同時送出，不受對沖名額限制（排隊時至少需要三輪 0.9 秒）
+    assert time.time() - start < 0.75
+    assert chat_calls(stub_openai) == 20
+
+
+def test_queued_long_audio_is_deferred_while_breaker_is_half_open(stub_openai):
+    client = make_client(max_retries=0, failure_threshold=1, recovery_timeout=0.1)
+    breaker = client.endpoints['audio'].breaker
+    breaker.record_failure()
+    time.sleep(0.15)
+    # 另一個請求正在進行半開試探
+    assert breaker.allow_request()
+    pushed = []
+
+    class RecordingLineBotApi:
+        def push_message(self, user_id, message):
+            pushed.append(message.text)
+
+    processor = LongAudioProcessor(openai_client=client, get_line_bot_api=RecordingLineBotApi)
+    assert processor.process_long_audio_async('U1', b"\0" * 1024, 'meeting.m4a', '1', defer_on_outage=True) is False
+    assert pushed == []